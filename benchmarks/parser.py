@@ -0,0 +1,80 @@
+"""Microbenchmark for parsing and rendering events.
+
+Reports, for each event type, how many events per second NSEvent parses and
+renders to Markdown, and how many memory blocks and bytes each parsed event holds.
+
+Run with the consumer's environment:
+    cd consumer && uv run ../benchmarks/parser.py
+"""
+
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "consumer"))
+
+from ns_event import EventType, NSEvent
+
+SAMPLES = {
+    EventType.MOVE: "@@testlandia@@ relocated from %%the_north_pacific%% to %%lazarus%%.",
+    EventType.FOUNDING: "@@testlandia@@ was founded in %%the_north_pacific%%.",
+    EventType.FOUNDING_REFOUND: "@@testlandia@@ was refounded in %%the_north_pacific%%.",
+    EventType.CTE: "@@testlandia@@ ceased to exist in %%the_north_pacific%%.",
+    EventType.MEMBER_APPLY: "@@testlandia@@ applied to join the World Assembly.",
+    EventType.MEMBER_ADMIT: "@@testlandia@@ was admitted to the World Assembly.",
+    EventType.MEMBER_RESIGN: "@@testlandia@@ resigned from the World Assembly.",
+    EventType.MEMBER_DELEGATE: "@@testlandia@@ became WA Delegate of %%the_north_pacific%%.",
+    EventType.MEMBER_DELEGATE_SEIZED: "@@testlandia@@ seized the position of %%the_north_pacific%% WA Delegate from @@maxtopia@@.",
+    EventType.MEMBER_DELEGATE_LOST: "@@testlandia@@ lost WA Delegate status in %%the_north_pacific%%.",
+    EventType.ENDO: "@@testlandia@@ endorsed @@maxtopia@@.",
+    EventType.ENDO_WITHDRAW: "@@testlandia@@ withdrew its endorsement from @@maxtopia@@.",
+}
+
+
+def rate(func, event_str: str, n: int) -> float:
+    """Calls of func per second, best of three runs of n calls."""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(n):
+            func(event_str)
+        best = min(best, time.perf_counter() - start)
+    return n / best
+
+
+def footprint(event_str: str, n: int) -> tuple[float, float]:
+    """Memory blocks and bytes held per parsed event, kept alive."""
+    gc.collect()
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    before = tracemalloc.get_traced_memory()[0]
+    events = [NSEvent(event_str) for _ in range(n)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    del events
+    return blocks / n, size / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=100_000, help="events per run")
+    args = parser.parse_args()
+
+    print(
+        f"{'event type':<24} {'parse/s':>12} {'parse+str/s':>12} {'blocks/ev':>10} {'bytes/ev':>10}"
+    )
+    for event_type, event_str in SAMPLES.items():
+        parse = rate(NSEvent, event_str, args.n)
+        render = rate(lambda s: str(NSEvent(s)), event_str, args.n)
+        blocks, size = footprint(event_str, args.n)
+        print(
+            f"{event_type.name:<24} {parse:>12,.0f} {render:>12,.0f} {blocks:>10.1f} {size:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
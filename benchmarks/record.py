@@ -0,0 +1,55 @@
+"""Record the live SSE feed to a compressed file for replay.py.
+
+Events are written in the journal's format, so journal segments can be replayed
+too. Recording stops after --duration seconds, or on Ctrl+C.
+
+Run with the consumer's environment:
+    cd consumer && uv run ../benchmarks/record.py recording.journal.gz --duration 3600
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "consumer"))
+
+from consumer import serversent_events
+from journal import format_event
+
+
+async def record(path: str, duration: float | None) -> int:
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        with contextlib.suppress(TimeoutError, asyncio.CancelledError):
+            async with asyncio.timeout(duration):
+                async for event in serversent_events():
+                    f.write(
+                        format_event(
+                            event["id"], int(event["time"].timestamp()), event["str"]
+                        )
+                    )
+                    count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="file to write, gzip compressed")
+    parser.add_argument("--duration", type=float, help="seconds to record for")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    try:
+        count = asyncio.run(record(args.output, args.duration))
+    except KeyboardInterrupt:
+        count = None
+    elapsed = time.perf_counter() - start_time
+    print(f"Recorded {'' if count is None else f'{count} '}events in {elapsed:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
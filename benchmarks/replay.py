@@ -0,0 +1,157 @@
+"""Replay a recording through the consumer pipeline and report its performance.
+
+Events from a recording made with record.py, or a journal segment, are fed into
+consume() in place of the live feed: at the pace they were recorded, sped up
+N times, or as fast as the pipeline takes them. They are applied to the database
+configured by POSTGRES_* as usual, so point it at a scratch database. Every event
+is routed to a catch-all channel whose webhook is a local stub server.
+
+Reports sustained events/s, and percentiles of the time from each event entering
+the pipeline to it being applied and routed, and to it being posted to the stub.
+
+Run with the consumer's environment:
+    cd consumer && uv run ../benchmarks/replay.py recording.journal.gz --speed 10
+"""
+
+import argparse
+import asyncio
+import gzip
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "consumer"))
+os.environ.setdefault("JOURNAL_DIR", "")
+
+from aiohttp import web
+
+import db
+from cache import nations
+from channels import Channel, Router
+from consumer import consume
+from delivery import Delivery
+from journal import parse_event
+from ns_event import NSEvent
+
+STUB_PORT = 8765
+DRAIN_TIMEOUT = 30
+
+
+def read_recording(path: str) -> list[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return [parse_event(line) for line in f if line.endswith("\n")]
+
+
+def percentiles(samples: list[float]) -> str:
+    if len(samples) < 2:
+        return "no samples"
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return ", ".join(
+        [f"p{p} {cuts[p - 1] * 1000:.1f}ms" for p in (50, 90, 99)]
+        + [f"max {max(samples) * 1000:.1f}ms"]
+    )
+
+
+class Stub:
+    """A webhook server that accepts every message after a fixed delay, noting when
+    each line of it arrived."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.messages = 0
+        self.received: list[tuple[str, float]] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        await asyncio.sleep(self.latency)
+        now = time.perf_counter()
+        self.messages += 1
+        self.received.extend((line, now) for line in payload["content"].split("\n"))
+        return web.Response(status=204)
+
+
+async def replay(events: list[dict], speed: float | None, latency: float) -> None:
+    stub = Stub(latency)
+    app = web.Application()
+    app.router.add_post("/webhook", stub.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+    router = Router([Channel("replay", f"http://127.0.0.1:{STUB_PORT}/webhook")])
+
+    entered: dict[int, float] = {}
+    applied: list[float] = []
+    # Rendered events waiting to reach the stub, with when they entered.
+    pending: dict[str, deque[float]] = defaultdict(deque)
+
+    async def source():
+        start_time = time.perf_counter()
+        first = events[0]["time"].timestamp() if events else 0
+        for i, event in enumerate(events):
+            if speed is not None:
+                due = start_time + (event["time"].timestamp() - first) / speed
+                if (delay := due - time.perf_counter()) > 0:
+                    await asyncio.sleep(delay)
+            # Ids are the recording's position, so each event can be followed.
+            entered[i] = time.perf_counter()
+            yield {**event, "id": i}
+
+    async with db.pool, Delivery() as delivery:
+        await nations.load()
+
+        async def deliver(event: NSEvent) -> None:
+            now = time.perf_counter()
+            applied.append(now - entered[event.id])  # type: ignore
+            for channel in router.route(event):
+                content = str(event)
+                pending[content].append(entered[event.id])  # type: ignore
+                delivery.send(channel, content)
+
+        print(f"Replaying {len(events)} events...")
+        start_time = time.perf_counter()
+        await consume(deliver, source())
+        elapsed = time.perf_counter() - start_time
+        # Let the webhook queues drain, unless messages were dropped.
+        sent = sum(map(len, pending.values()))
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+        while len(stub.received) < sent and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+
+    await runner.cleanup()
+    delivered = [now - pending[line].popleft() for line, now in stub.received]
+    print(
+        f"Applied {len(applied)} events in {elapsed:.2f}s: {len(applied) / elapsed:,.0f} events/s"
+    )
+    print(f"Entered to applied: {percentiles(applied)}")
+    print(
+        f"Entered to posted: {percentiles(delivered)} ({stub.messages} webhook messages, {sent - len(delivered)} events not posted)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording", help="file written by record.py, or a journal")
+    parser.add_argument(
+        "--speed",
+        default="max",
+        help="times real time to replay at, or max to replay as fast as possible",
+    )
+    parser.add_argument(
+        "--webhook-latency",
+        type=float,
+        default=0.05,
+        help="seconds the stub webhook takes to answer",
+    )
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    events = read_recording(args.recording)
+    asyncio.run(replay(events, speed, args.webhook_latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""Benchmark the hot paths of the consumer, ingester and bot on synthetic data.
+
+Each service is benchmarked in its own environment, against the database configured
+by POSTGRES_*; point it at a scratch database, as its contents are replaced:
+
+    ingester  parse and load rate of a generated nations dump, by phase
+    bot       get_endorsable_nations and get_tart latency by region size
+    consumer  event parsing, channel routing and applying events to the database
+
+`all` runs the three in that order, each through `uv run` in the service's
+directory, so the bot and consumer work on the world the ingester loaded. Results
+are written as JSON with --output, and compared with an earlier run's with
+--compare, flagging changes for the worse beyond --threshold.
+
+    uv run --directory consumer ../benchmarks/suite.py all --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import queue
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from synthetic import EVENT_MIX, World
+
+ROOT = Path(__file__).resolve().parent.parent
+SERVICES = ("ingester", "bot", "consumer")
+
+Results = dict[str, dict[str, float | str]]
+
+
+def result(results: Results, name: str, value: float, unit: str) -> None:
+    results[name] = {"value": round(value, 3), "unit": unit}
+    print(f"{name:<56} {value:>14,.2f} {unit}", file=sys.stderr)
+
+
+def best_rate(func, items: list, runs: int = 3) -> float:
+    """Items per second func handles, best of several runs over all of them."""
+    best = float("inf")
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start_time)
+    return len(items) / best
+
+
+def use_service(service: str) -> None:
+    sys.path.insert(0, str(ROOT / service))
+
+
+def bench_ingester(args: argparse.Namespace, results: Results) -> None:
+    use_service("ingester")
+    import dump_ingester
+
+    world = World(args.nations, args.regions, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "nations.xml.gz")
+        world.write_dump(path)
+
+        # Parsing alone, as the ingester's read and parse stages run it.
+        xml, rows = queue.Queue(dump_ingester.CHUNK_QUEUE_SIZE), queue.Queue()
+        stop = threading.Event()
+        start_time = time.perf_counter()
+        reader = threading.Thread(
+            target=dump_ingester.read_dump,
+            args=(dump_ingester.iter_file(path), xml, stop),
+        )
+        reader.start()
+        dump_ingester.parse_dump(xml, rows, stop)
+        reader.join()
+        elapsed = time.perf_counter() - start_time
+        result(results, "ingester.parse", args.nations / elapsed, "nations/s")
+
+        # A full ingest, parsing and loading the dump into the database.
+        start_time = time.perf_counter()
+        if not dump_ingester.ingest(
+            dump_ingester.iter_file(path), datetime.now(timezone.utc), full=True
+        ):
+            raise SystemExit("Ingesting the generated dump failed.")
+        result(results, "ingester.ingest", time.perf_counter() - start_time, "s")
+    for phase in ("stage", "merge", "endorsements", "fingerprints", "regions"):
+        rate = dump_ingester.registry.get_sample_value(
+            "rwa_ingester_rows_per_second", {"phase": phase}
+        )
+        result(results, f"ingester.{phase}", rate or 0.0, "rows/s")
+
+
+def percentile(samples: list[float], p: int) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[p - 1]
+
+
+async def bench_bot(args: argparse.Namespace, results: Results) -> None:
+    use_service("bot")
+    import db
+
+    rng = random.Random(args.seed)
+    async with db.pool:
+        async with db.pool.connection() as conn:
+            cur = await conn.execute(
+                """SELECT region, array_agg(name) FROM nations
+                WHERE wa_member GROUP BY region"""
+            )
+            regions = await cur.fetchall()
+
+        # WA members sampled from regions of each order of magnitude of members.
+        sizes: dict[int, list[str]] = {}
+        for _, members in regions:
+            sizes.setdefault(len(str(len(members))), []).extend(members)
+        for digits, members in sorted(sizes.items()):
+            label = f"{10 ** (digits - 1)}-{10**digits - 1}"
+            sample = rng.sample(members, min(args.samples, len(members)))
+            if len(sample) < 2:
+                continue
+            for query in (db.get_endorsable_nations, db.get_tart):
+                await query(sample[0])  # prepare the statement
+                latencies = []
+                for nation in sample:
+                    start_time = time.perf_counter()
+                    await query(nation)
+                    latencies.append((time.perf_counter() - start_time) * 1000)
+                for p in (50, 99):
+                    result(
+                        results,
+                        f"bot.{query.__name__}.members_{label}.p{p}",
+                        percentile(latencies, p),
+                        "ms",
+                    )
+
+
+async def bench_consumer(args: argparse.Namespace, results: Results) -> None:
+    use_service("consumer")
+    os.environ["JOURNAL_DIR"] = ""
+    import db
+    from cache import nations
+    from channels import Channel, Router
+    from consumer import consume
+    from ns_event import NSEvent
+
+    world = World(args.nations, args.regions, args.seed)
+    raw_events = world.events(args.events, seed=args.seed)
+
+    result(
+        results,
+        "consumer.parse",
+        best_rate(lambda e: NSEvent(e["str"]), raw_events),
+        "events/s",
+    )
+    parsed = [NSEvent(e["str"], e["id"], e["time"]) for e in raw_events]
+    for bucket in EVENT_MIX:
+        events = [e["str"] for e, p in zip(raw_events, parsed) if p.bucket == bucket]
+        result(
+            results, f"consumer.parse.{bucket}", best_rate(NSEvent, events), "events/s"
+        )
+
+    # Feed channels on the largest regions, each taking a few buckets, a catch-all
+    # channel per bucket, and endotarting channels.
+    rng = random.Random(args.seed)
+    channels = [
+        Channel(
+            f"feed {i}",
+            "",
+            regions=rng.sample(
+                world.regions[: args.regions // 10 + 1], rng.randint(1, 3)
+            ),
+            buckets=rng.sample(list(EVENT_MIX), rng.randint(1, len(EVENT_MIX))),
+        )
+        for i in range(args.channels)
+    ]
+    channels += [Channel(bucket, "", buckets=[bucket]) for bucket in EVENT_MIX]
+    channels += [
+        Channel(f"tart {region}", "", endotarting=True, regions=[region])
+        for region in world.regions[: args.channels // 10 + 1]
+    ]
+    router = Router(channels)
+    for nation, region in world.region_of.items():
+        nations.add(nation, region)
+    for members in world.members.values():
+        for nation in members:
+            nations.add(nation, world.region_of[nation], wa_member=True)
+    result(results, "consumer.route", best_rate(router.route, parsed), "events/s")
+
+    # Applying events to the database through the batched pipeline.
+    async def source():
+        for event in raw_events:
+            yield event
+
+    async def deliver(event: NSEvent) -> None:
+        pass
+
+    async with db.pool:
+        await nations.load()
+        start_time = time.perf_counter()
+        await consume(deliver, source())
+        elapsed = time.perf_counter() - start_time
+    result(results, "consumer.apply", args.events / elapsed, "events/s")
+
+
+def run_all(args: argparse.Namespace, results: Results) -> None:
+    """Run each service's benchmarks in its own environment."""
+    options = [
+        f"--nations={args.nations}",
+        f"--regions={args.regions}",
+        f"--events={args.events}",
+        f"--channels={args.channels}",
+        f"--samples={args.samples}",
+        f"--seed={args.seed}",
+    ]
+    for service in SERVICES:
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            subprocess.run(
+                [
+                    "uv",
+                    "run",
+                    "--directory",
+                    str(ROOT / service),
+                    str(Path(__file__).resolve()),
+                    service,
+                    f"--output={output.name}",
+                    *options,
+                ],
+                check=True,
+            )
+            with open(output.name) as f:
+                results.update(json.load(f)["results"])
+
+
+def compare(previous: dict, results: Results, threshold: float) -> int:
+    """Print the change in every result since a previous run, returning how many
+    got worse by more than the threshold."""
+    regressions = 0
+    print(f"\n{'benchmark':<56} {'before':>12} {'after':>12} {'change':>8}")
+    for name, current in results.items():
+        if (before := previous["results"].get(name)) is None or not before["value"]:
+            continue
+        change = current["value"] / before["value"] - 1  # type: ignore
+        # Rates are better higher, durations and latencies lower.
+        worse = -change if str(current["unit"]).endswith("/s") else change
+        flag = " REGRESSION" if worse > threshold else ""
+        regressions += bool(flag)
+        print(
+            f"{name:<56} {before['value']:>12,.2f} {current['value']:>12,.2f} {change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("suite", choices=("all", *SERVICES))
+    parser.add_argument("--nations", type=int, default=50_000)
+    parser.add_argument("--regions", type=int, default=2_500)
+    parser.add_argument("--events", type=int, default=20_000)
+    parser.add_argument(
+        "--channels", type=int, default=100, help="feed channels to route events to"
+    )
+    parser.add_argument(
+        "--samples", type=int, default=200, help="nations queried per region size"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write results to as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change for the worse reported as a regression",
+    )
+    args = parser.parse_args()
+
+    results: Results = {}
+    match args.suite:
+        case "all":
+            run_all(args, results)
+        case "ingester":
+            bench_ingester(args, results)
+        case "bot":
+            asyncio.run(bench_bot(args, results))
+        case "consumer":
+            asyncio.run(bench_consumer(args, results))
+
+    report = {
+        "suite": args.suite,
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": subprocess.run(
+            ["git", "-C", str(ROOT), "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip(),
+        "python": platform.python_version(),
+        "parameters": {
+            name: getattr(args, name)
+            for name in ("nations", "regions", "events", "channels", "samples", "seed")
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Deterministic synthetic data for the benchmarks: a world of nations, a nations
+dump of it, and a stream of events drawn from a mix of buckets.
+
+Region sizes follow a Zipf distribution, so a few regions hold most nations, as on
+NationStates. Within a region, each WA member endorses a Pareto-distributed number
+of other members, picked with a preference for the best-endorsed ones, so a
+delegate gathers far more endorsements than most members give."""
+
+import gzip
+import random
+from datetime import datetime, timedelta, timezone
+
+REGION_SKEW = 1.1
+WA_SHARE = 0.15
+ENDORSEMENT_SKEW = 1.3
+
+# Share of events in each bucket, roughly as seen on the live feed.
+EVENT_MIX = {"move": 0.25, "founding": 0.1, "cte": 0.1, "member": 0.2, "endo": 0.35}
+TEMPLATES = {
+    "move": ["@@{a}@@ relocated from %%{r}%% to %%{s}%%."],
+    "founding": [
+        "@@{n}@@ was founded in %%{r}%%.",
+        "@@{a}@@ was refounded in %%{r}%%.",
+    ],
+    "cte": ["@@{a}@@ ceased to exist in %%{r}%%."],
+    "member": [
+        "@@{a}@@ applied to join the World Assembly.",
+        "@@{a}@@ was admitted to the World Assembly.",
+        "@@{a}@@ resigned from the World Assembly.",
+        "@@{a}@@ became WA Delegate of %%{r}%%.",
+        "@@{a}@@ seized the position of %%{r}%% WA Delegate from @@{b}@@.",
+        "@@{a}@@ lost WA Delegate status in %%{r}%%.",
+    ],
+    "endo": [
+        "@@{a}@@ endorsed @@{b}@@.",
+        "@@{a}@@ withdrew its endorsement from @@{b}@@.",
+    ],
+}
+
+
+def display_name(name: str) -> str:
+    return name.replace("_", " ").title()
+
+
+class World:
+    """Nations spread over regions, with WA members and endorsements between them."""
+
+    def __init__(self, nations: int, regions: int, seed: int = 0):
+        rng = random.Random(seed)
+        self.regions = [f"region_{i}" for i in range(regions)]
+        self.nations = [f"nation_{i}" for i in range(nations)]
+        weights = [1 / (i + 1) ** REGION_SKEW for i in range(regions)]
+        self.region_of = dict(
+            zip(self.nations, rng.choices(self.regions, weights, k=nations))
+        )
+
+        # WA members of each region, best endorsed first; the first is the delegate.
+        self.members: dict[str, list[str]] = {}
+        for nation, region in self.region_of.items():
+            if rng.random() < WA_SHARE:
+                self.members.setdefault(region, []).append(nation)
+
+        # Endorsers of each nation, as the dump lists them.
+        self.endorsers: dict[str, list[str]] = {}
+        for members in self.members.values():
+            cum_weights, total = [], 0.0
+            for rank in range(len(members)):
+                total += 1 / (rank + 1)
+                cum_weights.append(total)
+            for endorser in members:
+                degree = min(len(members) - 1, int(rng.paretovariate(ENDORSEMENT_SKEW)))
+                endorsees: set[str] = set()
+                for _ in range(degree * 4):
+                    if len(endorsees) >= degree:
+                        break
+                    (endorsee,) = rng.choices(members, cum_weights=cum_weights)
+                    if endorsee != endorser:
+                        endorsees.add(endorsee)
+                for endorsee in endorsees:
+                    self.endorsers.setdefault(endorsee, []).append(endorser)
+
+    @property
+    def wa_members(self) -> int:
+        return sum(map(len, self.members.values()))
+
+    @property
+    def endorsements(self) -> int:
+        return sum(map(len, self.endorsers.values()))
+
+    def write_dump(self, path: str) -> None:
+        """Write the world as a gzipped nations dump, in the format NationStates
+        publishes it."""
+        delegates = {members[0] for members in self.members.values()}
+        members = {nation for members in self.members.values() for nation in members}
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n<NATIONS api_version="12">\n'
+            )
+            for nation, region in self.region_of.items():
+                if nation in delegates:
+                    status = "WA Delegate"
+                elif nation in members:
+                    status = "WA Member"
+                else:
+                    status = "Non-member"
+                f.write(
+                    f"<NATION><NAME>{display_name(nation)}</NAME>"
+                    f"<FULLNAME>The Republic of {display_name(nation)}</FULLNAME>"
+                    f"<REGION>{display_name(region)}</REGION>"
+                    f"<UNSTATUS>{status}</UNSTATUS>"
+                    f"<ENDORSEMENTS>{','.join(self.endorsers.get(nation, ()))}</ENDORSEMENTS>"
+                    f"<FLAG>https://www.nationstates.net/images/flags/{nation}.png</FLAG>"
+                    f"</NATION>\n"
+                )
+            f.write("</NATIONS>\n")
+
+    def events(
+        self, count: int, mix: dict[str, float] = EVENT_MIX, seed: int = 0
+    ) -> list[dict]:
+        """Raw events, as the consumer reads them off the feed, drawn from the mix of
+        buckets. Endorsements are between WA members of the same region."""
+        rng = random.Random(seed)
+        regions = [
+            region for region, members in self.members.items() if len(members) > 1
+        ]
+        start = datetime.now(timezone.utc)
+        events = []
+        for i, bucket in enumerate(rng.choices(list(mix), list(mix.values()), k=count)):
+            template = rng.choice(TEMPLATES[bucket])
+            if bucket == "endo" or "{b}" in template:
+                a, b = rng.sample(self.members[rng.choice(regions)], 2)
+            else:
+                a, b = rng.choice(self.nations), None
+            event_str = template.format(
+                a=a,
+                b=b,
+                n=f"founded_{seed}_{i}",
+                r=self.region_of[a],
+                s=rng.choice(self.regions),
+            )
+            events.append(
+                {"str": event_str, "id": i, "time": start + timedelta(milliseconds=i)}
+            )
+        return events
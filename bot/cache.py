@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+import db
+
+logger = logging.getLogger("discord")
+
+RECONNECT_DELAY = 5
+
+
+class RegionCache:
+    """In-memory copy of each region's WA members and who they have endorsed.
+
+    Regions are loaded from the database the first time /tart is used in them, and
+    dropped again when the consumer reports a change to them, so answers stay as
+    current as the database without re-running the query for every command."""
+
+    def __init__(self):
+        self._regions: dict[str, dict[str, frozenset[str]]] = {}
+        self._region_of: dict[str, str] = {}
+        self._generations: dict[str, int] = {}
+        self._listening = False
+
+    def _invalidate(self, region: str) -> None:
+        self._generations[region] = self._generations.get(region, 0) + 1
+        for nation in self._regions.pop(region, {}):
+            if self._region_of.get(nation) == region:
+                del self._region_of[nation]
+
+    def clear(self) -> None:
+        for region in list(self._regions):
+            self._invalidate(region)
+
+    async def _load(self, region: str) -> dict[str, frozenset[str]]:
+        generation = self._generations.get(region, 0)
+        members = {
+            name: frozenset(endorsed)
+            for name, endorsed in await db.get_region_endorsements(region)
+        }
+        # Only keep the copy if nothing changed while it was being read, and only
+        # while changes are being listened for.
+        if self._listening and self._generations.get(region, 0) == generation:
+            self._regions[region] = members
+            for name in members:
+                self._region_of[name] = region
+        return members
+
+    async def members(self, region: str) -> dict[str, frozenset[str]]:
+        """A region's WA members, with the nations each has endorsed."""
+        if (members := self._regions.get(region)) is None:
+            members = await self._load(region)
+        return members
+
+    async def tart(self, nation: str) -> tuple[bool, list[str]] | None:
+        """Like db.get_tart, answered from the cache where possible."""
+        if (region := self._region_of.get(nation)) is None:
+            if (status := await db.get_nation_status(nation)) is None:
+                return None
+            region, wa_member = status
+            if not wa_member:
+                return False, []
+        members = await self.members(region)
+        if nation not in members:
+            return False, []
+        endorsed = members[nation]
+        return True, [n for n in members if n != nation and n not in endorsed]
+
+    async def listen(self) -> None:
+        """Drop regions as the consumer changes them, until cancelled."""
+        while True:
+            try:
+                async for regions in db.region_changes():
+                    self._listening = True
+                    if regions is None:
+                        self.clear()
+                        continue
+                    for region in regions:
+                        self._invalidate(region)
+            except Exception as e:
+                logger.error(f"Lost region change notifications: {e}")
+            # Changes may be missed until listening again, so stop caching.
+            self._listening = False
+            self.clear()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+regions = RegionCache()
@@ -1,114 +1,273 @@
 import logging
 import os
+from collections.abc import AsyncIterator
 
-import psycopg
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
 
 logger = logging.getLogger(__name__)
 
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "db")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
 
 DB_CONFIG = {
-    "host": "db",
-    "port": 5432,
+    "host": POSTGRES_HOST,
+    "port": POSTGRES_PORT,
     "dbname": POSTGRES_DB,
     "user": POSTGRES_USER,
     "password": POSTGRES_PASSWORD,
+    "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", 10)),
 }
 
+pool = AsyncConnectionPool(
+    kwargs=DB_CONFIG,
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", 1)),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", 4)),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    max_idle=float(os.getenv("DB_POOL_MAX_IDLE", 600)),
+    max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", 3600)),
+    check=AsyncConnectionPool.check_connection,
+    name="bot",
+    open=False,
+)
 
-def nation_exists(nation: str) -> str:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM nations WHERE (name = %s)", (nation,))
-            if row := cur.fetchone():
+REGION_CHANNEL = "region_changes"
+
+
+async def nation_exists(nation: str) -> str:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT name FROM nations WHERE (name = %s)", (nation,), prepare=True
+            )
+            if row := await cur.fetchone():
                 return row[0]
             else:
                 return ""
 
 
-def search_nation(nation: str) -> dict[str, bool | list[str]]:
+async def search_nation(nation: str) -> dict[str, bool | list[str]]:
     """Search for a nation by name. If no exact match is found, return the three closest matches."""
-    if name := nation_exists(nation):
+    if name := await nation_exists(nation):
         return {"exact_match": True, "names": [name]}
     else:
-        with psycopg.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cur:
-                cur.execute(
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
                     """SELECT name FROM nations
-                            ORDER BY levenshtein(name, %(nation)s)
+                            ORDER BY name <-> %(nation)s
                             LIMIT 3""",
                     {"nation": nation},
+                    prepare=True,
                 )
-                names = [row[0] for row in cur.fetchall()]
+                names = [row[0] for row in await cur.fetchall()]
         return {"exact_match": False, "names": names}
 
 
-def get_region(nation: str) -> str | None:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT region FROM nations WHERE (name = %s)", (nation,))
-            region = cur.fetchone()
+async def autocomplete_nation(text: str, limit: int = 25) -> list[str]:
+    """Nations whose names start with text, then the closest other matches."""
+    prefix = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """SELECT name FROM nations
+                        WHERE name LIKE %(prefix)s
+                        ORDER BY name
+                        LIMIT %(limit)s""",
+                {"prefix": f"{prefix}%", "limit": limit},
+                prepare=True,
+            )
+            names = [row[0] for row in await cur.fetchall()]
+            if len(names) < limit:
+                await cur.execute(
+                    """SELECT name FROM nations
+                            ORDER BY name <-> %(text)s
+                            LIMIT %(limit)s""",
+                    {"text": text, "limit": limit},
+                    prepare=True,
+                )
+                names += [row[0] async for row in cur if row[0] not in names]
+    return names[:limit]
+
+
+async def get_region(nation: str) -> str | None:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT region FROM nations WHERE (name = %s)", (nation,), prepare=True
+            )
+            region = await cur.fetchone()
             if region is not None:
                 return region[0]
     return None
 
 
-def get_wa_status(nation: str) -> bool:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT wa_member FROM nations WHERE (name = %s)", (nation,))
-            wa_member = cur.fetchone()
+async def get_wa_status(nation: str) -> bool:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT wa_member FROM nations WHERE (name = %s)",
+                (nation,),
+                prepare=True,
+            )
+            wa_member = await cur.fetchone()
             if wa_member is not None:
                 return wa_member[0]
     return False
 
 
-def get_endorsements(nation: str) -> list[str]:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT endorsements FROM nations WHERE (name = %s)", (nation,))
-            endorsements = cur.fetchone()
-            if endorsements is not None:
-                return endorsements[0]
-    return []
+async def get_endorsements(nation: str) -> list[str]:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT endorser FROM endorsements WHERE (endorsee = %s)",
+                (nation,),
+                prepare=True,
+            )
+            return [row[0] for row in await cur.fetchall()]
 
 
-def get_endorsable_nations(nation: str) -> list[str]:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+async def get_endorsable_nations(nation: str) -> list[str]:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """SELECT n2.name FROM nations n1
                 JOIN nations n2 ON n1.name <> n2.name
                 WHERE n1.name = %(nation)s
                 AND n2.region = n1.region
                 AND n2.wa_member
-                AND n1.name <> ALL(n2.endorsements)""",
+                AND NOT EXISTS (
+                    SELECT FROM endorsements e
+                    WHERE e.endorsee = n2.name AND e.endorser = n1.name
+                )""",
+                {"nation": nation},
+                prepare=True,
+            )
+            return [row[0] for row in await cur.fetchall()]
+
+
+async def get_tart(nation: str) -> tuple[bool, list[str]] | None:
+    """Whether a nation is a WA member, and if so which nations in its region it
+    hasn't endorsed, in one round trip. None if the nation doesn't exist."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """SELECT n1.wa_member, CASE WHEN n1.wa_member THEN array(
+                    SELECT n2.name FROM nations n2
+                    WHERE n2.region = n1.region
+                    AND n2.wa_member
+                    AND n2.name <> n1.name
+                    AND NOT EXISTS (
+                        SELECT FROM endorsements e
+                        WHERE e.endorsee = n2.name AND e.endorser = n1.name
+                    )
+                ) END
+                FROM nations n1
+                WHERE n1.name = %(nation)s""",
                 {"nation": nation},
+                prepare=True,
             )
-            return [row[0] for row in cur.fetchall()]
-        
-def get_non_endorsing_nations(nation: str) -> list[str]:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+            if (row := await cur.fetchone()) is None:
+                return None
+            return row[0], row[1] or []
+
+
+async def get_non_endorsing_nations(nation: str) -> list[str]:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """SELECT n2.name FROM nations n1
                 JOIN nations n2 ON n1.name <> n2.name
                 WHERE n1.name = %(nation)s
                 AND n2.region = n1.region
                 AND n2.wa_member
-                AND n2.name <> ALL(n1.endorsements)""",
+                AND NOT EXISTS (
+                    SELECT FROM endorsements e
+                    WHERE e.endorsee = n1.name AND e.endorser = n2.name
+                )""",
                 {"nation": nation},
+                prepare=True,
             )
-            return [row[0] for row in cur.fetchall()]
+            return [row[0] for row in await cur.fetchall()]
 
 
-def get_flag(nation: str) -> str | None:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT flag FROM nations WHERE (name = %s)", (nation,))
-            flag = cur.fetchone()
+async def get_flag(nation: str) -> str | None:
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT flag FROM nations WHERE (name = %s)", (nation,), prepare=True
+            )
+            flag = await cur.fetchone()
             if flag is not None:
                 return flag[0]
     return None
+
+
+async def get_nation_status(nation: str) -> tuple[str, bool] | None:
+    """A nation's region and whether it is a WA member, or None if it doesn't exist."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT region, wa_member FROM nations WHERE (name = %s)",
+                (nation,),
+                prepare=True,
+            )
+            return await cur.fetchone()
+
+
+async def get_region_stats(region: str) -> tuple[int, int, str | None, int] | None:
+    """A region's active nations, WA members, delegate and the delegate's
+    endorsements, or None if it doesn't exist."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """SELECT nations, wa_members, delegate, delegate_endorsements
+                FROM regions WHERE (name = %s)""",
+                (region,),
+                prepare=True,
+            )
+            return await cur.fetchone()
+
+
+async def get_delegate_race(region: str, limit: int) -> list[tuple[str, int]]:
+    """A region's active WA members with the most endorsements, most endorsed first."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """SELECT n.name, (
+                    SELECT count(*) FROM endorsements e WHERE e.endorsee = n.name
+                ) AS endorsements FROM nations n
+                WHERE n.region = %(region)s AND n.wa_member AND n.active
+                ORDER BY endorsements DESC, n.name LIMIT %(limit)s""",
+                {"region": region, "limit": limit},
+                prepare=True,
+            )
+            return await cur.fetchall()
+
+
+async def get_region_endorsements(region: str) -> list[tuple[str, list[str]]]:
+    """Every WA member of a region, with the nations each has endorsed."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """SELECT n.name, array(
+                    SELECT e.endorsee FROM endorsements e WHERE e.endorser = n.name
+                ) FROM nations n
+                WHERE n.region = %(region)s AND n.wa_member""",
+                {"region": region},
+                prepare=True,
+            )
+            return await cur.fetchall()
+
+
+async def region_changes() -> AsyncIterator[list[str] | None]:
+    """Listen for the regions the consumer changes, yielding None once listening
+    starts and whenever every region may have changed."""
+    async with await AsyncConnection.connect(**DB_CONFIG, autocommit=True) as conn:
+        await conn.execute(f"LISTEN {REGION_CHANNEL}")
+        yield None
+        async for notify in conn.notifies():
+            yield notify.payload.split("\n") if notify.payload else None
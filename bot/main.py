@@ -1,7 +1,9 @@
+import asyncio
 import io
 import logging
 import logging.handlers
 import os
+import time
 from datetime import datetime, timedelta, timezone
 
 import aiohttp
@@ -11,6 +13,9 @@ from discord.ext import commands
 from discord.interactions import InteractionMessage
 
 import db
+import metrics
+from cache import regions
+from matrix import EndorsementMatrix
 
 logger = logging.getLogger("discord")
 handler = logging.handlers.RotatingFileHandler(
@@ -62,6 +67,12 @@ if DISCORD_TOKEN is None:
     logger.critical("DISCORD_TOKEN environment variable not set, exiting")
     raise ValueError("DISCORD_TOKEN environment variable not set")
 
+# Regions with more WA members than this get their endorsement report as a file.
+MATRIX_INLINE_MEMBERS = 8
+MESSAGE_LIMIT = 2000
+# Contenders listed by /race.
+RACE_LENGTH = 10
+
 description = """Real-time World Assembly - a project by Nova Aohr
 
 For inquiries, message @syntoxine
@@ -75,12 +86,24 @@ MY_GUILD = discord.Object(int(os.getenv("DEV_GUILD", 0)))
 
 
 class Arwa(commands.Bot):
+    # Only started once setup_hook has opened the pool.
+    region_listener: asyncio.Task | None = None
+
     async def setup_hook(self):
+        await db.pool.open()
+        metrics.serve()
+        self.region_listener = asyncio.create_task(regions.listen())
         # Sync the command tree with the guild if in dev mode, else globally
         if MY_GUILD.id != 0:
             self.tree.copy_global_to(guild=MY_GUILD)
             await self.tree.sync(guild=MY_GUILD)
 
+    async def close(self):
+        if self.region_listener is not None:
+            self.region_listener.cancel()
+        await super().close()
+        await db.pool.close()
+
 
 arwa = Arwa(command_prefix=":", intents=intents, description=description)
 
@@ -101,21 +124,22 @@ async def tart(interaction: discord.Interaction, nation: str):
     else:
         return
 
+    start_time = time.perf_counter()
     nation = to_snake_case(nation)
-    if not db.nation_exists(nation):
-        await interaction_message.edit(
-            content=f"No nation by the name {to_title_case(nation)} exists!"
-        )
-        return
-
-    if not db.get_wa_status(nation):
+    tart = await regions.tart(nation)
+    query_time = time.perf_counter() - start_time
+    if tart is None:
+        content = f"No nation by the name {to_title_case(nation)} exists!"
+        if names := (await db.search_nation(nation))["names"]:
+            content += (
+                f" Did you mean {', '.join(get_md_nation_link(n) for n in names)}?"
+            )
+        await interaction_message.edit(content=content)
+    elif not tart[0]:
         await interaction_message.edit(
             content=f"{to_title_case(nation)} is not a WA member, and can't endorse anyone!"
         )
-        return
-
-    endorsable_nations = db.get_endorsable_nations(nation)
-    if not endorsable_nations:
+    elif not (endorsable_nations := tart[1]):
         await interaction_message.edit(
             content=f"{to_title_case(nation)} has endorsed everyone it could in its region!"
         )
@@ -129,6 +153,134 @@ async def tart(interaction: discord.Interaction, nation: str):
         else:
             content = f"{prefix} {', '.join(nations)}."
         await interaction_message.edit(content=content)
+    total_time = time.perf_counter() - start_time
+    metrics.TART_SECONDS.labels("query").observe(query_time)
+    metrics.TART_SECONDS.labels("total").observe(total_time)
+    logger.info(
+        f"/tart {nation} took {total_time * 1000:.0f}ms (query {query_time * 1000:.0f}ms)"
+    )
+
+
+@tart.autocomplete("nation")
+async def nation_autocomplete(
+    interaction: discord.Interaction, current: str
+) -> list[app_commands.Choice[str]]:
+    names = await db.autocomplete_nation(to_snake_case(current))
+    return [app_commands.Choice(name=to_title_case(n), value=n) for n in names]
+
+
+@arwa.tree.command()
+@app_commands.describe(region="The name of the region")
+async def region(interaction: discord.Interaction, region: str):
+    """Use this command to get a region's nation and WA member counts, and its delegate."""
+    region = to_snake_case(region)
+    stats = await db.get_region_stats(region)
+    if stats is None:
+        await interaction.response.send_message(
+            f"No region by the name {to_title_case(region)} exists!"
+        )
+        return
+    nations, wa_members, delegate, delegate_endorsements = stats
+    content = f"{get_md_region_link(region)} has {nations} nations, {wa_members} of them in the WA."
+    if delegate is None:
+        content += " It has no WA Delegate."
+    else:
+        content += f" Its WA Delegate is {get_md_nation_link(delegate)}, with {delegate_endorsements} endorsements."
+    await interaction.response.send_message(content)
+
+
+@arwa.tree.command()
+@app_commands.describe(region="The name of the region")
+async def race(interaction: discord.Interaction, region: str):
+    """Use this command to see a region's most endorsed WA members, and how they compare to its delegate."""
+    region = to_snake_case(region)
+    stats = await db.get_region_stats(region)
+    if stats is None:
+        await interaction.response.send_message(
+            f"No region by the name {to_title_case(region)} exists!"
+        )
+        return
+    _, _, delegate, delegate_endorsements = stats
+    contenders = await db.get_delegate_race(region, RACE_LENGTH)
+    if not contenders:
+        await interaction.response.send_message(
+            f"{to_title_case(region)} has no WA members!"
+        )
+        return
+    lines = [f"Most endorsed WA members of {get_md_region_link(region)}:"]
+    for rank, (nation, endorsements) in enumerate(contenders, 1):
+        line = f"{rank}. {get_md_nation_link(nation)}, {endorsements} endorsements"
+        if nation == delegate:
+            line += " (WA Delegate)"
+        elif delegate is not None:
+            lead = endorsements - delegate_endorsements
+            if lead > 0:
+                line += f" ({lead} ahead of the WA Delegate)"
+            elif lead < 0:
+                line += f" ({-lead} behind the WA Delegate)"
+            else:
+                line += " (level with the WA Delegate)"
+        lines.append(line)
+    if delegate is not None and delegate not in (nation for nation, _ in contenders):
+        lines.append(
+            f"The WA Delegate, {get_md_nation_link(delegate)}, has {delegate_endorsements} endorsements."
+        )
+    await interaction.response.send_message("\n".join(lines))
+
+
+@arwa.tree.command()
+@app_commands.describe(region="The name of the region")
+async def endorsements(interaction: discord.Interaction, region: str):
+    """Use this command to see who every WA member in a region hasn't endorsed, and who hasn't endorsed them."""
+    callback_response = await interaction.response.defer()
+    if callback_response is not None:
+        interaction_message: InteractionMessage = callback_response.resource  # type: ignore
+    else:
+        return
+
+    start_time = time.perf_counter()
+    region = to_snake_case(region)
+    members = await regions.members(region)
+    if not members:
+        await interaction_message.edit(
+            content=f"{to_title_case(region)} has no WA members!"
+        )
+        return
+    report = await asyncio.to_thread(EndorsementMatrix, members)
+    top = ", ".join(
+        f"{get_md_nation_link(report.names[i])} ({report.received[i]})"
+        for i in report.ranking[:3]
+    )
+    content = (
+        f"{get_md_region_link(region)} has {len(report)} WA members, with {report.edges} endorsements between them "
+        f"({report.density:.0%} of all possible, {report.reciprocity:.0%} returned). Most endorsed: {top}."
+    )
+    inline = None
+    if len(report) <= MATRIX_INLINE_MEMBERS:
+        lines = [content]
+        for i in report.ranking:
+            not_endorsed, not_endorsed_by = report.gaps(i)
+            lines.append(
+                f"- {to_title_case(report.names[i])} hasn't endorsed {', '.join(map(to_title_case, not_endorsed)) or 'no one'}, "
+                f"and isn't endorsed by {', '.join(map(to_title_case, not_endorsed_by)) or 'no one'}."
+            )
+        inline = "\n".join(lines)
+    if inline is not None and len(inline) <= MESSAGE_LIMIT:
+        await interaction_message.edit(content=inline)
+    else:
+        report_csv = await asyncio.to_thread(report.to_csv)
+        await interaction_message.edit(
+            content=content,
+            attachments=[
+                discord.File(
+                    io.BytesIO(report_csv.encode()),
+                    filename=f"{region}_endorsements.csv",
+                )
+            ],
+        )
+    logger.info(
+        f"/endorsements {region} took {(time.perf_counter() - start_time) * 1000:.0f}ms ({len(report)} members)"
+    )
 
 
 arwa.run(DISCORD_TOKEN)
@@ -0,0 +1,110 @@
+import csv
+import io
+import os
+
+import numpy as np
+
+# Regions with up to this many WA members get the names of every gap in the report,
+# not just how many there are.
+MATRIX_LIST_LIMIT = int(os.getenv("MATRIX_LIST_LIMIT", 300))
+
+
+class EndorsementMatrix:
+    """A region's endorsements as a boolean adjacency matrix over its WA members.
+
+    Members are indexed in name order, and endorsed[i, j] is set when member i has
+    endorsed member j. Endorsements of nations that aren't WA members of the region
+    are left out. Every per-member figure is computed from the matrix at once."""
+
+    def __init__(self, members: dict[str, frozenset[str]]):
+        self.names = np.array(sorted(members), dtype=str)
+        n = len(self.names)
+
+        # Edges as (endorser, endorsee) indices, -1 for endorsees outside the region.
+        index = {name: i for i, name in enumerate(self.names.tolist())}
+        endorsed_by_member = [members[name] for name in index]
+        degrees = [len(endorsed) for endorsed in endorsed_by_member]
+        endorsees = np.fromiter(
+            (index.get(e, -1) for endorsed in endorsed_by_member for e in endorsed),
+            dtype=np.intp,
+            count=sum(degrees),
+        )
+        endorsers = np.repeat(np.arange(n), degrees)
+        known = endorsees >= 0
+
+        self.endorsed = np.zeros((n, n), dtype=bool)
+        self.endorsed[endorsers[known], endorsees[known]] = True
+        np.fill_diagonal(self.endorsed, False)
+
+        self.received = np.count_nonzero(self.endorsed, axis=0)
+        self.given = np.count_nonzero(self.endorsed, axis=1)
+        self.mutual = np.count_nonzero(self.endorsed & self.endorsed.T, axis=1)
+        # Members endorsing each one that it hasn't endorsed back.
+        self.unreturned = self.received - self.mutual
+        self.not_endorsed = n - 1 - self.given
+        self.not_endorsed_by = n - 1 - self.received
+        # Most endorsed first, ties broken by name.
+        self.ranking = np.lexsort((self.names, -self.received))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def edges(self) -> int:
+        return int(self.given.sum())
+
+    @property
+    def reciprocity(self) -> float:
+        """Share of endorsements that are returned."""
+        return float(self.mutual.sum() / self.edges) if self.edges else 0.0
+
+    @property
+    def density(self) -> float:
+        """Share of all possible endorsements between members that have been made."""
+        n = len(self)
+        return self.edges / (n * (n - 1)) if n > 1 else 0.0
+
+    def gaps(self, i: int) -> tuple[list[str], list[str]]:
+        """The members member i hasn't endorsed, and the members that haven't
+        endorsed it."""
+        not_endorsed = ~self.endorsed[i]
+        not_endorsed_by = ~self.endorsed[:, i]
+        not_endorsed[i] = not_endorsed_by[i] = False
+        return (
+            self.names[not_endorsed].tolist(),
+            self.names[not_endorsed_by].tolist(),
+        )
+
+    def to_csv(self) -> str:
+        """The report, one row per member in ranking order."""
+        lists = len(self) <= MATRIX_LIST_LIMIT
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(
+            [
+                "rank",
+                "nation",
+                "endorsements",
+                "endorsed",
+                "mutual",
+                "unreturned",
+                "not_endorsed",
+                "not_endorsed_by",
+            ]
+            + (["not_endorsed_names", "not_endorsed_by_names"] if lists else [])
+        )
+        for rank, i in enumerate(self.ranking.tolist(), 1):
+            row = [
+                rank,
+                self.names[i],
+                self.received[i],
+                self.given[i],
+                self.mutual[i],
+                self.unreturned[i],
+                self.not_endorsed[i],
+                self.not_endorsed_by[i],
+            ]
+            if lists:
+                row += [" ".join(names) for names in self.gaps(i)]
+            writer.writerow(row)
+        return out.getvalue()
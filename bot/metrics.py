@@ -0,0 +1,22 @@
+import logging
+import os
+
+from prometheus_client import Histogram, start_http_server
+
+logger = logging.getLogger("discord")
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+TART_SECONDS = Histogram(
+    "rwa_tart_seconds",
+    "Time taken to answer /tart, by stage: looking up the nations, or the whole command",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+def serve() -> None:
+    """Serve metrics over HTTP if METRICS_PORT is set."""
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+        logger.info(f"Serving metrics on port {METRICS_PORT}")
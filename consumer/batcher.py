@@ -0,0 +1,462 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+from collections import Counter
+from collections.abc import Iterable
+
+import psycopg
+
+import db
+import metrics
+from cache import ACTIVE, WA_DELEGATE, WA_MEMBER, nations, written_nations
+from journal import journal
+from ns_event import EventType, NSEvent
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_EVENTS = int(os.getenv("BATCH_MAX_EVENTS", 500))
+BATCH_MAX_LATENCY_MS = int(os.getenv("BATCH_MAX_LATENCY_MS", 250))
+APPLY_SHARDS = int(os.getenv("APPLY_SHARDS", 1))
+RETRY_DELAY = 1
+RETRY_DELAY_MAX = 60
+
+# Errors caused by the events written rather than the database being unreachable,
+# which applying the events one by one gets around.
+DATA_ERRORS = (psycopg.DataError, psycopg.IntegrityError)
+
+COLUMN_EVENTS: dict[EventType, tuple[str, bool | None]] = {
+    EventType.MOVE: ("region", None),  # value is the destination region
+    EventType.CTE: ("active", False),
+    EventType.MEMBER_ADMIT: ("wa_member", True),
+    EventType.MEMBER_RESIGN: ("wa_member", False),
+    EventType.MEMBER_DELEGATE: ("wa_delegate", True),
+    EventType.MEMBER_DELEGATE_LOST: ("wa_delegate", False),
+}
+
+# Order in which a batch's statement groups are executed.
+GROUP_RANK = {
+    "founding": 0,
+    "region": 1,
+    "active": 2,
+    "wa_member": 3,
+    "wa_delegate": 4,
+    "endorsements": 5,
+}
+
+
+def changed_regions(events: list[NSEvent]) -> set[str]:
+    """Regions whose WA members or endorsements the events change.
+
+    Must be called before the events are applied to the nation cache, so nations
+    are looked up in the region they were in."""
+    regions: set[str | None] = set()
+    for event in events:
+        match event.event_type:
+            case EventType.MOVE:
+                regions.update(event.parameters)
+            case EventType.FOUNDING | EventType.FOUNDING_REFOUND:
+                regions.add(event.parameters[0])
+                regions.add(nations.region(event.nation))
+            case (
+                EventType.CTE
+                | EventType.MEMBER_ADMIT
+                | EventType.MEMBER_RESIGN
+                | EventType.ENDO
+                | EventType.ENDO_WITHDRAW
+            ):
+                regions.add(nations.region(event.nation))
+    regions.discard(None)
+    return regions  # type: ignore
+
+
+class RegionDeltas:
+    """Changes a run of events makes to the regions table: its active nation and WA
+    member counts, and its delegate.
+
+    Worked out from the nation cache, by comparing each nation an event touches
+    before and after the event is applied to it."""
+
+    def __init__(self):
+        self.nations: Counter[str] = Counter()
+        self.wa_members: Counter[str] = Counter()
+        # The last nation to become each region's delegate, and the (region, nation)
+        # pairs of delegates that lost the position since.
+        self.elected: dict[str, str] = {}
+        self.deposed: set[tuple[str, str]] = set()
+        # Regions whose delegate may have gained or lost endorsements.
+        self.endorsed: set[str] = set()
+
+    def changed(self) -> set[str]:
+        return self.endorsed.union(
+            self.nations,
+            self.wa_members,
+            self.elected,
+            (region for region, _ in self.deposed),
+        )
+
+    def _count(self, state: tuple[str, int] | None, sign: int) -> None:
+        if state is not None and state[1] & ACTIVE:
+            self.nations[state[0]] += sign
+            if state[1] & WA_MEMBER:
+                self.wa_members[state[0]] += sign
+
+    def _depose(self, region: str, nation: str) -> None:
+        if self.elected.get(region) == nation:
+            del self.elected[region]
+        self.deposed.add((region, nation))
+
+    def apply(self, event: NSEvent) -> None:
+        """Apply an event to the nation cache, recording how it changes regions."""
+        touched = [event.nation]
+        match event.event_type:
+            case EventType.MEMBER_DELEGATE_SEIZED:
+                touched.insert(0, event.parameters[1])
+            case EventType.ENDO:
+                touched.append(event.parameters[0])
+        before = [nations.state(nation) for nation in touched]
+        nations.apply(event)
+
+        for nation, old in zip(touched, before):
+            new = nations.state(nation)
+            self._count(old, -1)
+            self._count(new, 1)
+            # Delegates lose the position when they are replaced or move out of or
+            # cease to exist in their region.
+            if old is not None and (
+                (
+                    event.event_type == EventType.MEMBER_DELEGATE_LOST
+                    and nation == event.nation
+                )
+                or (
+                    event.event_type == EventType.MEMBER_DELEGATE_SEIZED
+                    and nation == event.parameters[1]
+                )
+                or (
+                    old[1] & WA_DELEGATE
+                    and (new is None or new[0] != old[0] or not new[1] & ACTIVE)
+                )
+            ):
+                self._depose(old[0], nation)
+            if (
+                new is not None
+                and new[1] & ACTIVE
+                and nation == event.nation
+                and event.event_type
+                in (EventType.MEMBER_DELEGATE, EventType.MEMBER_DELEGATE_SEIZED)
+            ):
+                self.elected[new[0]] = nation
+        if event.event_type in (EventType.ENDO, EventType.ENDO_WITHDRAW):
+            if region := nations.region(event.parameters[0]):
+                self.endorsed.add(region)
+
+
+class EventBatch:
+    """A run of events whose writes can be applied as one set of set-based statements.
+
+    Writes are grouped by statement (foundings, one group per column, endorsements)
+    and coalesced, last write wins, per nation. An event is only accepted if applying
+    the groups in GROUP_RANK order gives the same result as applying the events one
+    by one; otherwise add() refuses it and the caller starts a new batch."""
+
+    def __init__(self):
+        self.foundings: dict[str, str] = {}
+        self.columns: dict[str, dict[str, str | bool]] = {
+            column: {} for column in ("region", "active", "wa_member", "wa_delegate")
+        }
+        self.endorsements: dict[tuple[str, str], bool] = {}
+        self._writes: dict[tuple[str, str], str] = {}
+
+    @staticmethod
+    def writes(event: NSEvent) -> list[tuple[str, str, str | bool]]:
+        """The (nation, column, value) writes an event makes."""
+        match event.event_type:
+            case EventType.FOUNDING | EventType.FOUNDING_REFOUND:
+                return [(event.nation, "founding", event.parameters[0])]
+            case EventType.MEMBER_DELEGATE_SEIZED:
+                return [
+                    (event.parameters[1], "wa_delegate", False),
+                    (event.nation, "wa_delegate", True),
+                ]
+            case EventType.ENDO | EventType.ENDO_WITHDRAW:
+                return [
+                    (
+                        event.parameters[0],
+                        "endorsements",
+                        event.event_type == EventType.ENDO,
+                    )
+                ]
+            case event_type if event_type in COLUMN_EVENTS:
+                column, value = COLUMN_EVENTS[event_type]
+                if value is None:
+                    value = event.parameters[1]
+                return [(event.nation, column, value)]
+        return []
+
+    def _conflicts(self, nation: str, group: str) -> bool:
+        if group == "founding":
+            # Foundings run first, so must not overtake earlier writes to the nation.
+            return any(
+                self._writes.get((nation, other), "founding") != "founding"
+                for other in GROUP_RANK
+            )
+        prior = self._writes.get((nation, group))
+        return prior is not None and GROUP_RANK[prior] > GROUP_RANK[group]
+
+    def add(self, event: NSEvent) -> bool:
+        """Add an event to the batch, returning False if it has to go in a later one."""
+        writes = self.writes(event)
+        if any(self._conflicts(nation, group) for nation, group, _ in writes):
+            return False
+        if event.event_type in (EventType.ENDO, EventType.ENDO_WITHDRAW):
+            # Keep endorse/withdraw flip-flops apart: endorsing may insert the endorsee.
+            endorsee, endorsed = writes[0][0], writes[0][2]
+            if self.endorsements.get((endorsee, event.nation), endorsed) != endorsed:
+                return False
+            # The endorser's region must be readable, so it can't be inserted alongside.
+            if (event.nation, "endorsements") in self._writes:
+                return False
+        for nation, group, value in writes:
+            match group:
+                case "founding":
+                    self.foundings[nation] = value  # type: ignore
+                    for column in ("founding", "region", "active", "wa_member"):
+                        self._writes[(nation, column)] = "founding"
+                case "endorsements":
+                    self.endorsements[(nation, event.nation)] = value  # type: ignore
+                    # Endorsing an unknown nation inserts it, writing every column,
+                    # with the region read from the endorser.
+                    for column in GROUP_RANK:
+                        if column != "founding":
+                            self._writes[(nation, column)] = "endorsements"
+                    self._writes[(event.nation, "region")] = "endorsements"
+                case _:
+                    self.columns[group][nation] = value
+                    self._writes[(nation, group)] = group
+        return True
+
+
+async def write_batches(
+    batches: list[EventBatch],
+    regions: Iterable[str] = (),
+    deltas: RegionDeltas | None = None,
+) -> None:
+    """db.apply_batches, retried with backoff for as long as the database can't be
+    reached, as the nation cache and journal have already moved past the events.
+
+    Any other error is raised: data errors for the caller to work around, the rest
+    to stop the consumer."""
+    delay = RETRY_DELAY
+    while True:
+        try:
+            await db.apply_batches(batches, regions, deltas)
+            return
+        except psycopg.OperationalError as e:
+            logger.error(f"Error writing to the database, retrying in {delay}s: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RETRY_DELAY_MAX)
+
+
+class BatchWriter:
+    """Write-behind buffer that applies events in batches.
+
+    Events are flushed in a single transaction once BATCH_MAX_EVENTS have been
+    buffered, or BATCH_MAX_LATENCY_MS after the first buffered event, whichever
+    comes first."""
+
+    def __init__(
+        self,
+        max_events: int = BATCH_MAX_EVENTS,
+        max_latency: float = BATCH_MAX_LATENCY_MS / 1000,
+    ):
+        self.max_events = max_events
+        self.max_latency = max_latency
+        self.events: list[NSEvent] = []
+        self.batches: list[EventBatch] = [EventBatch()]
+        self._deadline: float | None = None
+
+    def add(self, event: NSEvent) -> None:
+        journal.append(event)
+        if not self.batches[-1].add(event):
+            self.batches.append(EventBatch())
+            self.batches[-1].add(event)
+        self.events.append(event)
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.max_latency
+
+    def full(self) -> bool:
+        return len(self.events) >= self.max_events
+
+    def time_left(self) -> float | None:
+        """Seconds until the buffer is due to be flushed, or None if it is empty."""
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+    async def flush(self) -> list[NSEvent]:
+        """Apply all buffered events, returning them in arrival order."""
+        events, batches = self.events, self.batches
+        self.events, self.batches, self._deadline = [], [EventBatch()], None
+        if not events:
+            return events
+
+        start_time = time.perf_counter()
+        # Journal first, so every applied event can be replayed.
+        await journal.sync()
+        # Nations the ingester added since the cache was loaded are only in the table.
+        await nations.fill(
+            nation for event in events for nation in written_nations(event)
+        )
+        regions = changed_regions(events)
+        deltas = RegionDeltas()
+        for event in events:
+            deltas.apply(event)
+        try:
+            await write_batches(batches, regions, deltas)
+        except DATA_ERRORS as e:
+            logger.error(
+                f"Error applying batch of {len(events)} events, retrying one by one: {e}"
+            )
+            for event in events:
+                batch = EventBatch()
+                batch.add(event)
+                try:
+                    await write_batches([batch])
+                except DATA_ERRORS as e:
+                    logger.error(f"Error applying event {event!r}: {e}")
+            # The nation cache has every event applied, so the regions follow it.
+            try:
+                await write_batches([], regions, deltas)
+            except DATA_ERRORS as e:
+                logger.error(f"Error updating regions: {e}")
+        nations.hold(events)
+        elapsed = time.perf_counter() - start_time
+        metrics.STAGE_SECONDS.labels("apply").observe(elapsed)
+        logger.debug(
+            f"Applied {len(events)} events in {len(batches)} batches ({elapsed:.3f}s)"
+        )
+        return events
+
+    async def _forward(self, out: asyncio.Queue) -> None:
+        for applied in await self.flush():
+            try:
+                out.put_nowait(applied)
+            except asyncio.QueueFull:
+                logger.warning(f"Delivery queue full, dropping {applied!r} from feed")
+
+    async def _apply(self, inp: asyncio.Queue, out: asyncio.Queue) -> None:
+        while True:
+            try:
+                item = await asyncio.wait_for(inp.get(), self.time_left())
+            except TimeoutError:
+                await self._forward(out)
+                continue
+            if item is None:
+                break
+            if isinstance(item, Fence):
+                await self._forward(out)
+                await item.pass_through(self, out)
+                continue
+            self.add(item)
+            if self.full() or self.time_left() == 0:
+                await self._forward(out)
+        await self._forward(out)
+
+    async def run(self, inp: asyncio.Queue, out: asyncio.Queue) -> None:
+        """Apply events from inp in batches, forwarding each batch to out once committed.
+
+        Delivery never applies backpressure here: if the delivery queue is full the
+        event is dropped from the feed rather than holding up the database."""
+        await self._apply(inp, out)
+        await out.put(None)
+
+
+class Fence:
+    """An event that touches nations in several shards.
+
+    Every shard involved flushes what it has buffered and waits at the fence. Once
+    all of them have arrived, the owning shard applies the event on its own, then
+    lets the others carry on, so the event is ordered after everything before it and
+    before everything after it for each of its nations."""
+
+    def __init__(self, event: NSEvent, owner: BatchWriter, parties: int):
+        self.event = event
+        self.owner = owner
+        self._waiting = parties
+        self._arrived = asyncio.Event()
+        self._applied = asyncio.Event()
+
+    async def pass_through(self, writer: BatchWriter, out: asyncio.Queue) -> None:
+        self._waiting -= 1
+        if self._waiting == 0:
+            self._arrived.set()
+        if writer is not self.owner:
+            await self._applied.wait()
+            return
+        await self._arrived.wait()
+        writer.add(self.event)
+        await writer._forward(out)
+        self._applied.set()
+
+
+class ShardedWriter:
+    """Applies events with several BatchWriters at once, partitioned by nation.
+
+    Events are routed to a shard by a hash of the nation they write to, so each
+    nation's events are applied in order by one shard while shards flush
+    concurrently, each on its own pooled connection. Events that write to nations in
+    more than one shard, and delegate changes, go through a Fence."""
+
+    def __init__(
+        self,
+        shards: int = APPLY_SHARDS,
+        queue_size: int = 0,
+        max_events: int = BATCH_MAX_EVENTS,
+        max_latency: float = BATCH_MAX_LATENCY_MS / 1000,
+    ):
+        self.writers = [BatchWriter(max_events, max_latency) for _ in range(shards)]
+        self.queues: list[asyncio.Queue] = [
+            asyncio.Queue(queue_size) for _ in range(shards)
+        ]
+
+    def shard(self, nation: str) -> int:
+        # crc32 rather than hash(), which is salted per process, so nations land on
+        # the same shard across restarts.
+        return zlib.crc32(nation.encode()) % len(self.writers)
+
+    def shards(self, event: NSEvent) -> list[int]:
+        """The shards owning the nations an event writes to, its own nation's first."""
+        touched = [event.nation]
+        match event.event_type:
+            case (
+                EventType.MEMBER_DELEGATE
+                | EventType.MEMBER_DELEGATE_LOST
+                | EventType.MEMBER_DELEGATE_SEIZED
+            ):
+                # A region's delegate is set by whichever shard commits last, so
+                # delegate changes are fenced off from every shard's other writes.
+                own = self.shard(event.nation)
+                return [own, *(i for i in range(len(self.writers)) if i != own)]
+            case EventType.ENDO if event.parameters[0] not in nations:
+                # Endorsement edges are routed by endorser, but endorsing a nation
+                # that isn't known yet also inserts it.
+                touched.append(event.parameters[0])
+        return list(dict.fromkeys(self.shard(nation) for nation in touched))
+
+    async def run(self, inp: asyncio.Queue, out: asyncio.Queue) -> None:
+        """Like BatchWriter.run, applying events across every shard."""
+        async with asyncio.TaskGroup() as tg:
+            for writer, queue in zip(self.writers, self.queues):
+                tg.create_task(writer._apply(queue, out))
+            while (ns_event := await inp.get()) is not None:
+                first, *others = self.shards(ns_event)
+                if not others:
+                    await self.queues[first].put(ns_event)
+                    continue
+                fence = Fence(ns_event, self.writers[first], 1 + len(others))
+                for shard in (first, *others):
+                    await self.queues[shard].put(fence)
+            for queue in self.queues:
+                await queue.put(None)
+        await out.put(None)
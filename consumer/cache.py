@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import sys
+import time
+from collections.abc import Iterable
+
+import db
+from ns_event import EventType, NSEvent
+
+logger = logging.getLogger(__name__)
+
+WA_MEMBER = 1
+WA_DELEGATE = 2
+ACTIVE = 4
+
+RECONNECT_DELAY = 5
+
+
+def written_nations(event: NSEvent) -> list[str]:
+    """The nations whose cached state an event can change."""
+    match event.event_type:
+        case EventType.MEMBER_DELEGATE_SEIZED:
+            return [event.nation, event.parameters[1]]
+        case EventType.ENDO:
+            return [event.nation, event.parameters[0]]
+    return [event.nation]
+
+
+class NationCache:
+    """Compact in-memory copy of every nation's region and WA/active status.
+
+    Nations are numbered in insertion order; each one costs a dict entry plus one
+    pointer to an interned region name and one byte of flags."""
+
+    def __init__(self):
+        self._index: dict[str, int] = {}
+        self._regions: list[str] = []
+        self._flags = bytearray()
+        # Nations changed while the cache is being reloaded, None otherwise.
+        self._held: set[str] | None = None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, nation: str) -> bool:
+        return nation in self._index
+
+    def add(
+        self,
+        nation: str,
+        region: str,
+        wa_member: bool = False,
+        wa_delegate: bool = False,
+        active: bool = True,
+    ) -> None:
+        self._put(
+            nation,
+            region,
+            (WA_MEMBER if wa_member else 0)
+            | (WA_DELEGATE if wa_delegate else 0)
+            | (ACTIVE if active else 0),
+        )
+
+    def _put(self, nation: str, region: str, flags: int) -> None:
+        if (i := self._index.get(nation)) is not None:
+            self._regions[i] = sys.intern(region)
+            self._flags[i] = flags
+        else:
+            self._index[sys.intern(nation)] = len(self._regions)
+            self._regions.append(sys.intern(region))
+            self._flags.append(flags)
+
+    def region(self, nation: str) -> str | None:
+        if (i := self._index.get(nation)) is not None:
+            return self._regions[i]
+        return None
+
+    def state(self, nation: str) -> tuple[str, int] | None:
+        """A nation's region and flags, or None if it isn't cached."""
+        if (i := self._index.get(nation)) is not None:
+            return self._regions[i], self._flags[i]
+        return None
+
+    def _flag(self, nation: str, flag: int) -> bool:
+        if (i := self._index.get(nation)) is not None:
+            return bool(self._flags[i] & flag)
+        return False
+
+    def wa_member(self, nation: str) -> bool:
+        return self._flag(nation, WA_MEMBER)
+
+    def wa_delegate(self, nation: str) -> bool:
+        return self._flag(nation, WA_DELEGATE)
+
+    def active(self, nation: str) -> bool:
+        return self._flag(nation, ACTIVE)
+
+    def _set_flag(self, nation: str, flag: int, value: bool) -> None:
+        if (i := self._index.get(nation)) is not None:
+            if value:
+                self._flags[i] |= flag
+            else:
+                self._flags[i] &= ~flag
+
+    def apply(self, event: NSEvent) -> None:
+        """Mirror the changes db.apply_batches makes for an event."""
+        self.hold((event,))
+        match event.event_type:
+            case EventType.FOUNDING | EventType.FOUNDING_REFOUND:
+                self.add(
+                    event.nation,
+                    event.parameters[0],
+                    wa_delegate=self.wa_delegate(event.nation),
+                )
+            case EventType.MOVE:
+                if (i := self._index.get(event.nation)) is not None:
+                    self._regions[i] = sys.intern(event.parameters[1])
+            case EventType.CTE:
+                self._set_flag(event.nation, ACTIVE, False)
+            case EventType.MEMBER_ADMIT | EventType.MEMBER_RESIGN:
+                self._set_flag(
+                    event.nation, WA_MEMBER, event.event_type == EventType.MEMBER_ADMIT
+                )
+            case EventType.MEMBER_DELEGATE | EventType.MEMBER_DELEGATE_LOST:
+                self._set_flag(
+                    event.nation,
+                    WA_DELEGATE,
+                    event.event_type == EventType.MEMBER_DELEGATE,
+                )
+            case EventType.MEMBER_DELEGATE_SEIZED:
+                self._set_flag(event.parameters[1], WA_DELEGATE, False)
+                self._set_flag(event.nation, WA_DELEGATE, True)
+            case EventType.ENDO:
+                endorsee = event.parameters[0]
+                if endorsee not in self and (region := self.region(event.nation)):
+                    self.add(endorsee, region, wa_member=True)
+
+    def hold(self, events: Iterable[NSEvent]) -> None:
+        """Keep the cached state of the nations events change through a reload in
+        progress, which may have read them from before the events were written."""
+        if self._held is not None:
+            for event in events:
+                self._held.update(written_nations(event))
+
+    async def load(self) -> None:
+        """Fill the cache from the nations table, replacing what it held.
+
+        Events keep being applied while the table is read, so nations they change
+        in the meantime keep the state the events gave them."""
+        start_time = time.perf_counter()
+        fresh = NationCache()
+        self._held = set()
+        try:
+            async for name, region, wa_member, wa_delegate, active in db.get_nations():
+                fresh.add(name, region, wa_member, wa_delegate, active)
+            for nation in self._held:
+                if (state := self.state(nation)) is not None:
+                    fresh._put(nation, *state)
+        finally:
+            self._held = None
+        self._index, self._regions, self._flags = (
+            fresh._index,
+            fresh._regions,
+            fresh._flags,
+        )
+        logger.info(
+            f"Cached {len(self)} nations. ({time.perf_counter() - start_time:.2f}s)"
+        )
+
+    async def fill(self, names: Iterable[str]) -> None:
+        """Cache the nations missing from the cache that the nations table has,
+        such as ones the ingester added since the cache was loaded."""
+        missing = [name for name in dict.fromkeys(names) if name not in self]
+        if not missing:
+            return
+        for name, region, wa_member, wa_delegate, active in await db.find_nations(
+            missing
+        ):
+            # Events may have added the nation while it was being looked up.
+            if name not in self:
+                self.add(name, region, wa_member, wa_delegate, active)
+
+    async def follow_ingests(self, loaded: asyncio.Event) -> None:
+        """Reload the cache whenever the ingester has loaded a dump, until cancelled.
+
+        The cache is loaded once listening starts, then set loaded. Dumps ingested
+        while not listening would go unnoticed, so it is also reloaded on
+        reconnecting."""
+        while True:
+            try:
+                async for _ in db.dumps_ingested():
+                    await self.load()
+                    loaded.set()
+            except Exception as e:
+                logger.error(f"Lost dump ingestion notifications: {e}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+nations = NationCache()
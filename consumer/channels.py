@@ -1,16 +1,18 @@
-import tomllib
+import asyncio
 import logging
+import os
+import tomllib
+from collections import defaultdict
+from collections.abc import AsyncIterator
 
-import discord
-import aiohttp
-
-import db
-from ns_event import EventType
+from cache import nations
+from ns_event import EventType, NSEvent
 
 logger = logging.getLogger(__name__)
 
-USERNAME = "RWA Feed"
-AVATAR_URL = "https://files.dussud.org/NovaAohr/2560w1x1.png"
+CONFIG_PATH = "channels.toml"
+RELOAD_INTERVAL = float(os.getenv("CHANNELS_RELOAD_INTERVAL", 5))
+PRIORITIES = ("high", "low")
 
 
 class Channel:
@@ -21,16 +23,23 @@ class Channel:
         endotarting: bool = False,
         regions=None,
         buckets=None,
+        priority: str | None = None,
     ):
         self.name = name
         self.url = webhook_url
         self.endotarting = endotarting
+        # Endotarting alerts are time-critical, so they jump the queue by default.
+        self.priority = priority or ("high" if endotarting else "low")
+        if self.priority not in PRIORITIES:
+            raise ValueError(
+                f"Channel [{name}] has invalid priority {self.priority!r}, expected one of {PRIORITIES}"
+            )
         self.regions: list[str] = regions if regions is not None else []
         self.buckets: list[str] = buckets if buckets is not None else []
 
     @staticmethod
     def read_config() -> list["Channel"]:
-        with open("channels.toml", "rb") as f:
+        with open(CONFIG_PATH, "rb") as f:
             config = tomllib.load(f)
         channels = []
         for channel, settings in config.items():
@@ -49,45 +58,72 @@ class Channel:
                     endotarting=settings.get("endotarting", False),
                     regions=settings.get("regions", None),
                     buckets=settings.get("buckets", None),
+                    priority=settings.get("priority", None),
                 )
             )
         return channels
 
-    def match(self, event) -> bool:
-        """Check if the event matches the channel's filters"""
-        bucket = event.event_type.get_bucket()
-        region = db.get_region(event.nation)
-        region2 = event.parameters[0] if event.event_type == EventType.MOVE else None
-        if region in self.regions or region2 in self.regions or not self.regions:
-            if self.endotarting:
-                if region in self.regions and (
-                    (
-                        event.event_type == EventType.MOVE
-                        and db.get_wa_status(event.nation)
-                    )
-                    or (event.event_type == EventType.MEMBER_ADMIT)
-                ):
-                    return True
-                return False
-            elif bucket in self.buckets or not self.buckets:
-                return True
-        return False
-
-    async def send(self, content: str):
-        """Send the content to the channel's webhook URL"""
-        if len(content) > 2000:
-            raise ValueError(
-                "Content exceeds Discord message length limit of 2000 characters."
-            )
-        async with aiohttp.ClientSession() as session:
-            try:
-                webhook = discord.Webhook.from_url(self.url, session=session)
-                await webhook.send(
-                    content, username=f"{USERNAME} - {self.name}", avatar_url=AVATAR_URL
-                )
-            except Exception as e:
-                logger.error(f"Error sending message in channel [{self.name}]: {e}")
 
+class Router:
+    """Channels indexed by region and bucket, so routing an event is a few lookups.
+
+    Feed channels are keyed by every (region, bucket) pair they accept, with None
+    standing for "any". Endotarting channels are keyed by region alone."""
 
-def get_channels() -> list[Channel]:
-    return Channel.read_config()
+    def __init__(self, channels: list[Channel]):
+        self.channels = channels
+        self._feeds: dict[tuple[str | None, str | None], list[Channel]] = defaultdict(
+            list
+        )
+        self._endotarting: dict[str, list[Channel]] = defaultdict(list)
+        for channel in channels:
+            if channel.endotarting:
+                for region in channel.regions:
+                    self._endotarting[region].append(channel)
+                continue
+            for region in channel.regions or [None]:
+                for bucket in channel.buckets or [None]:
+                    self._feeds[(region, bucket)].append(channel)
+
+    def route(self, event: NSEvent) -> list[Channel]:
+        """The channels an event should be sent to."""
+        bucket = event.bucket
+        region = nations.region(event.nation)
+        regions = [region, None]
+        if event.event_type == EventType.MOVE:
+            regions.append(event.parameters[0])
+
+        matched: dict[Channel, None] = {}
+        for r in regions:
+            for b in (bucket, None):
+                matched.update(dict.fromkeys(self._feeds.get((r, b), ())))
+        if region is not None and (
+            (event.event_type == EventType.MOVE and nations.wa_member(event.nation))
+            or event.event_type == EventType.MEMBER_ADMIT
+        ):
+            matched.update(dict.fromkeys(self._endotarting.get(region, ())))
+        return list(matched)
+
+    @classmethod
+    def from_config(cls) -> "Router":
+        return cls(Channel.read_config())
+
+
+async def watch_config(interval: float = RELOAD_INTERVAL) -> AsyncIterator[Router]:
+    """Yield a new Router each time the channel config changes on disk.
+
+    A config that fails to load is logged and skipped, leaving the last good one
+    in place."""
+    mtime = os.stat(CONFIG_PATH).st_mtime_ns
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            new_mtime = os.stat(CONFIG_PATH).st_mtime_ns
+            if new_mtime == mtime:
+                continue
+            mtime = new_mtime
+            router = Router.from_config()
+        except Exception as e:
+            logger.error(f"Error reloading channel config: {e}")
+            continue
+        yield router
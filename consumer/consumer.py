@@ -1,10 +1,16 @@
+import asyncio
 import logging
 import os
-from collections.abc import Generator
+import time
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Callable
+from datetime import datetime, timezone
+from typing import Any, Mapping
 
 import sans
 
-import db
+import metrics
+from batcher import APPLY_SHARDS, BatchWriter, ShardedWriter
 from ns_event import NSEvent
 
 logger = logging.getLogger(__name__)
@@ -13,12 +19,188 @@ USER_AGENT = os.getenv("NS_USER_AGENT")
 if USER_AGENT is None:
     raise ValueError("NS_USER_AGENT environment variable not set")
 
+BUCKETS = ("move", "founding", "cte", "member", "endo")
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 1000))
+SSE_IDLE_TIMEOUT = float(os.getenv("SSE_IDLE_TIMEOUT", 120))
+SSE_RECONNECT_DELAY = float(os.getenv("SSE_RECONNECT_DELAY", 5))
+HAPPENINGS_LIMIT = 100
+SEEN_IDS = 10_000
+
+# A server-sent event as yielded by sans: "str", plus "id" and "time" if known.
+RawEvent = Mapping[str, Any]
+
 sans.set_agent(USER_AGENT)
-def consume() -> Generator[NSEvent]:
 
-    for event in sans.serversent_events(None, "move", "founding", "cte", "member", "endo"):
-        ns_event = NSEvent(event["str"])
-        logger.info(ns_event)
-        db.event_update(ns_event)
 
-        yield ns_event
+async def stream_events() -> AsyncIterator[RawEvent]:
+    """Yield raw events from one connection to the SSE feed.
+
+    Raises TimeoutError if the stream goes SSE_IDLE_TIMEOUT seconds without an
+    event, as a stalled connection is otherwise never noticed."""
+    events = aiter(sans.serversent_events(None, *BUCKETS))
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(anext(events), SSE_IDLE_TIMEOUT)
+            except StopAsyncIteration:
+                return
+            yield event
+    finally:
+        await events.aclose()
+
+
+async def backfill(since_id: int, before_id: int) -> list[RawEvent]:
+    """Fetch the events between two event ids from the happenings API, oldest first."""
+    events: list[RawEvent] = []
+    async with sans.AsyncClient() as client:
+        while True:
+            response = await client.get(
+                sans.World(
+                    "happenings",
+                    filter=" ".join(BUCKETS),
+                    sinceid=since_id,
+                    beforeid=before_id,
+                    limit=HAPPENINGS_LIMIT,
+                )
+            )
+            response.raise_for_status()
+            page = [
+                {
+                    "id": int(element.get("id")),  # type: ignore
+                    "time": datetime.fromtimestamp(
+                        int(element.findtext("TIMESTAMP")),  # type: ignore
+                        timezone.utc,
+                    ),
+                    "str": element.findtext("TEXT"),
+                }
+                for element in response.xml.iter("EVENT")
+            ]
+            events.extend(event for event in page if since_id < event["id"] < before_id)
+            # Happenings come newest first, so page backwards until the gap is covered.
+            if len(page) < HAPPENINGS_LIMIT:
+                break
+            before_id = min(event["id"] for event in page)
+    events.sort(key=lambda event: event["id"])
+    return events
+
+
+async def backfill_gap(since_id: int | None, before_id: int) -> list[RawEvent]:
+    """Backfill the events missed while reconnecting, timing it for metrics."""
+    if since_id is None:
+        return []
+    start_time = time.perf_counter()
+    try:
+        events = await backfill(since_id, before_id)
+    except Exception as e:
+        logger.error(f"Error backfilling events {since_id} to {before_id}: {e!r}")
+        return []
+    finally:
+        metrics.SSE_BACKFILL_SECONDS.observe(time.perf_counter() - start_time)
+    metrics.SSE_BACKFILLED_EVENTS.inc(len(events))
+    return events
+
+
+async def serversent_events() -> AsyncIterator[RawEvent]:
+    """Yield raw events from the NationStates SSE feed, without gaps or repeats.
+
+    When the stream drops it is reopened after SSE_RECONNECT_DELAY seconds. Once the
+    new stream produces its first event, the events missed in between are fetched
+    from the happenings API and yielded ahead of it. Events are deduplicated by id,
+    so overlap between the stream and backfill is never applied twice."""
+    seen_order: deque[int] = deque()
+    seen: set[int] = set()
+    last_id: int | None = None
+    dropped_at: float | None = None
+
+    def unseen(event: RawEvent) -> bool:
+        if event["id"] in seen:
+            return False
+        seen.add(event["id"])
+        seen_order.append(event["id"])
+        if len(seen_order) > SEEN_IDS:
+            seen.discard(seen_order.popleft())
+        return True
+
+    while True:
+        try:
+            async for event in stream_events():
+                if dropped_at is not None:
+                    downtime = time.monotonic() - dropped_at
+                    metrics.SSE_RECONNECT_SECONDS.observe(downtime)
+                    dropped_at = None
+                    missed = await backfill_gap(last_id, event["id"])
+                    logger.warning(
+                        f"Reconnected to SSE feed after {downtime:.1f}s, backfilled {len(missed)} events"
+                    )
+                    for missed_event in missed:
+                        if unseen(missed_event):
+                            yield missed_event
+                if unseen(event):
+                    last_id = max(last_id or 0, event["id"])
+                    yield event
+            logger.warning("SSE feed closed by server")
+        except Exception as e:
+            logger.warning(f"SSE feed dropped: {e!r}")
+        if dropped_at is None:
+            dropped_at = time.monotonic()
+        await asyncio.sleep(SSE_RECONNECT_DELAY)
+
+
+async def read_events(source: AsyncIterable[RawEvent], out: asyncio.Queue) -> None:
+    """Reader stage: pull raw events off the source as fast as it produces them."""
+    async for event in source:
+        await out.put(event)
+    await out.put(None)
+
+
+async def parse_events(inp: asyncio.Queue, out: asyncio.Queue) -> None:
+    """Parse stage: turn raw events into NSEvents."""
+    parse_seconds = metrics.STAGE_SECONDS.labels("parse")
+    while (event := await inp.get()) is not None:
+        start_time = time.perf_counter()
+        try:
+            ns_event = NSEvent(event["str"], event.get("id"), event.get("time"))
+        except ValueError as e:
+            logger.warning(f"Skipping unparseable event: {e}")
+            continue
+        parse_seconds.observe(time.perf_counter() - start_time)
+        metrics.EVENTS.labels(ns_event.bucket).inc()
+        await out.put(ns_event)
+    await out.put(None)
+
+
+async def deliver_events(
+    inp: asyncio.Queue, deliver: Callable[[NSEvent], Awaitable[None]]
+) -> None:
+    """Routing/delivery stage: hand applied events to the delivery callback."""
+    while (ns_event := await inp.get()) is not None:
+        await deliver(ns_event)
+
+
+async def consume(
+    deliver: Callable[[NSEvent], Awaitable[None]],
+    source: AsyncIterable[RawEvent] | None = None,
+) -> None:
+    """Run the consumer pipeline until the source is exhausted.
+
+    Each stage runs as its own task, joined to the next by a bounded queue, so a
+    slow database never stalls reading from the stream and a slow webhook never
+    delays database state."""
+    raw: asyncio.Queue[RawEvent | None] = asyncio.Queue(QUEUE_SIZE)
+    parsed: asyncio.Queue[NSEvent | None] = asyncio.Queue(QUEUE_SIZE)
+    applied: asyncio.Queue[NSEvent | None] = asyncio.Queue(QUEUE_SIZE)
+
+    for name, queue in (("raw", raw), ("parsed", parsed), ("applied", applied)):
+        metrics.watch_queue(name, queue)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(read_events(source or serversent_events(), raw))
+        tg.create_task(parse_events(raw, parsed))
+        if APPLY_SHARDS > 1:
+            writer = ShardedWriter(APPLY_SHARDS, QUEUE_SIZE)
+            for i, queue in enumerate(writer.queues):
+                metrics.watch_queue(f"shard{i}", queue)
+            tg.create_task(writer.run(parsed, applied))
+        else:
+            tg.create_task(BatchWriter().run(parsed, applied))
+        tg.create_task(deliver_events(applied, deliver))
@@ -1,121 +1,240 @@
 import logging
 import os
+from collections.abc import AsyncIterator, Iterable
+from datetime import datetime
+from typing import TYPE_CHECKING
 
-import psycopg
+from psycopg import AsyncConnection
 from psycopg.sql import SQL, Identifier
+from psycopg_pool import AsyncConnectionPool
 
-from ns_event import EventType, NSEvent
+if TYPE_CHECKING:
+    from batcher import EventBatch, RegionDeltas
 
 logger = logging.getLogger(__name__)
 
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "db")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
 
 DB_CONFIG = {
-    "host": "db",
-    "port": 5432,
+    "host": POSTGRES_HOST,
+    "port": POSTGRES_PORT,
     "dbname": POSTGRES_DB,
     "user": POSTGRES_USER,
     "password": POSTGRES_PASSWORD,
+    "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", 10)),
 }
 
-
-def event_update(event: NSEvent) -> None:
-    match event.event_type:
-        case EventType.ENDO | EventType.ENDO_WITHDRAW:
-            endorsements = get_endorsements(event.parameters[0])
-
-            match event.event_type:
-                case EventType.ENDO:
-                    endorsements.append(event.nation)
-                case EventType.ENDO_WITHDRAW:
-                    if event.nation in endorsements:
-                        endorsements.remove(event.nation)
-
-            with psycopg.connect(**DB_CONFIG) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE nations SET endorsements = %s WHERE (name = %s)",
-                        (endorsements, event.parameters[0]),
-                    )
-
-        case EventType.FOUNDING | EventType.FOUNDING_REFOUND:
-            upsert_sql = """INSERT INTO nations (name, region, active)
-            VALUES (%s, %s, TRUE)
+pool = AsyncConnectionPool(
+    kwargs=DB_CONFIG,
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", 1)),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", 4)),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    max_idle=float(os.getenv("DB_POOL_MAX_IDLE", 600)),
+    max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", 3600)),
+    check=AsyncConnectionPool.check_connection,
+    name="consumer",
+    open=False,
+)
+
+# Fixed queries, prepared server-side on each pooled connection on first use.
+UPSERT_FOUNDINGS = """INSERT INTO nations (name, region, active)
+            SELECT name, region, TRUE FROM unnest(%s::text[], %s::text[]) AS v(name, region)
             ON CONFLICT (name) DO UPDATE SET
             ( region, wa_member, active ) = (EXCLUDED.region, FALSE, TRUE);"""
-            with psycopg.connect(**DB_CONFIG) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        upsert_sql,
-                        (event.nation, event.parameters[0]),
-                    )
-
-        case EventType.MEMBER_APPLY:
-            pass  # No action needed for MEMBER_APPLY
-
-        case EventType.MEMBER_DELEGATE_SEIZED:
-            with psycopg.connect(**DB_CONFIG) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE nations SET wa_delegate = FALSE WHERE (name = %s)",
-                        (event.parameters[1],),
-                    ).execute(
-                        "UPDATE nations SET wa_delegate = TRUE WHERE (name = %s)",
-                        (event.nation,),
-                    )
-
-        case _:
-            match event.event_type:
-                case EventType.MOVE:
-                    payload = ("region", event.parameters[1])
-                case EventType.CTE:
-                    payload = ("active", False)
-                case EventType.MEMBER_ADMIT:
-                    payload = ("wa_member", True)
-                case EventType.MEMBER_RESIGN:
-                    payload = ("wa_member", False)
-                case EventType.MEMBER_DELEGATE:
-                    payload = ("wa_delegate", True)
-                case EventType.MEMBER_DELEGATE_LOST:
-                    payload = ("wa_delegate", False)
-
-            with psycopg.connect(**DB_CONFIG) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        SQL("UPDATE nations SET {} = %s WHERE (name = %s)").format(
-                            Identifier(payload[0])
-                        ),
-                        (payload[1], event.nation),
+UPDATE_COLUMN = {
+    column: SQL(
+        """UPDATE nations SET {column} = v.value
+        FROM unnest(%s::text[], %s::{type}[]) AS v(name, value)
+        WHERE nations.name = v.name"""
+    ).format(column=Identifier(column), type=SQL(type_))
+    for column, type_ in (
+        ("region", "text"),
+        ("active", "boolean"),
+        ("wa_member", "boolean"),
+        ("wa_delegate", "boolean"),
+    )
+}
+# Endorsements are edges added or removed one at a time on the server, so concurrent
+# writers cannot lose each other's updates. Endorsing a nation that isn't in the table
+# yet also adds it as a WA member of the endorser's region; nations that already exist
+# are filtered out first, so their rows aren't locked by other writers' inserts.
+ADD_ENDORSEMENTS = """WITH e AS (
+                SELECT * FROM unnest(%s::text[], %s::text[]) AS v(endorsee, endorser)
+            ), placeholders AS (
+                INSERT INTO nations (name, region, wa_member)
+                SELECT DISTINCT ON (e.endorsee) e.endorsee, n.region, TRUE
+                FROM e JOIN nations AS n ON n.name = e.endorser
+                WHERE NOT EXISTS (SELECT FROM nations WHERE name = e.endorsee)
+                ORDER BY e.endorsee
+                ON CONFLICT (name) DO NOTHING
+            )
+            INSERT INTO endorsements (endorser, endorsee)
+            SELECT endorser, endorsee FROM e
+            ON CONFLICT DO NOTHING"""
+REMOVE_ENDORSEMENTS = """DELETE FROM endorsements AS e
+            USING unnest(%s::text[], %s::text[]) AS v(endorsee, endorser)
+            WHERE e.endorsee = v.endorsee AND e.endorser = v.endorser"""
+# Regions whose WA members or endorsements changed, newline separated, sent on commit.
+# The ingester notifies the same channel with no payload once it has loaded a dump.
+REGION_CHANNEL = "region_changes"
+NOTIFY_REGION_CHANGES = (
+    "SELECT pg_notify('region_changes', payload) FROM unnest(%s::text[]) AS payload"
+)
+NOTIFY_PAYLOAD_LIMIT = 7999
+# Region aggregates are adjusted by each transaction's deltas, in one statement
+# locking every changed region in name order, so concurrent writers can't deadlock.
+# A delegate is only cleared if it is one of the nations that lost the position.
+UPSERT_REGIONS = """WITH v AS (
+                SELECT * FROM unnest(%s::text[], %s::int[], %s::int[], %s::text[])
+                AS v(name, nations, wa_members, elected)
+            ), deposed AS (
+                SELECT * FROM unnest(%s::text[], %s::text[]) AS d(region, nation)
+            )
+            INSERT INTO regions AS r (name, nations, wa_members, delegate)
+            SELECT name, nations, wa_members, elected FROM v ORDER BY name
+            ON CONFLICT (name) DO UPDATE SET
+                nations = r.nations + EXCLUDED.nations,
+                wa_members = r.wa_members + EXCLUDED.wa_members,
+                delegate = CASE
+                    WHEN EXCLUDED.delegate IS NOT NULL THEN EXCLUDED.delegate
+                    WHEN (r.name, r.delegate) IN (SELECT * FROM deposed) THEN NULL
+                    ELSE r.delegate
+                END
+            WHERE EXCLUDED.nations <> 0 OR EXCLUDED.wa_members <> 0
+                OR EXCLUDED.delegate IS NOT NULL
+                OR (r.name, r.delegate) IN (SELECT * FROM deposed)"""
+COUNT_DELEGATE_ENDORSEMENTS = """UPDATE regions AS r SET delegate_endorsements = (
+                SELECT count(*) FROM endorsements AS e WHERE e.endorsee = r.delegate
+            )
+            WHERE r.name = ANY(%s::text[])
+            AND r.delegate_endorsements <> (
+                SELECT count(*) FROM endorsements AS e WHERE e.endorsee = r.delegate
+            )"""
+SELECT_NATIONS = "SELECT name, region, wa_member, wa_delegate, active FROM nations"
+FIND_NATIONS = SELECT_NATIONS + " WHERE name = ANY(%s::text[])"
+SELECT_LAST_DUMP_TIME = "SELECT max(dump_time) FROM ingested_dumps"
+
+
+def _notify_payloads(regions: Iterable[str]) -> list[str]:
+    payloads, payload = [], ""
+    for region in regions:
+        if payload and len(payload) + 1 + len(region) > NOTIFY_PAYLOAD_LIMIT:
+            payloads.append(payload)
+            payload = ""
+        payload = f"{payload}\n{region}" if payload else region
+    if payload:
+        payloads.append(payload)
+    return payloads
+
+
+async def apply_batches(
+    batches: list["EventBatch"],
+    regions: Iterable[str] = (),
+    deltas: "RegionDeltas | None" = None,
+) -> None:
+    """Apply batches of events in order, in a single transaction, notifying
+    listeners of the regions that changed once it commits.
+
+    With deltas, the regions table is brought up to date in the same transaction,
+    recounting the delegate's endorsements in each changed region."""
+    regions = set(regions)
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            if payloads := _notify_payloads(regions):
+                await conn.execute(NOTIFY_REGION_CHANGES, (payloads,), prepare=True)
+            for batch in batches:
+                if batch.foundings:
+                    await conn.execute(
+                        UPSERT_FOUNDINGS,
+                        (list(batch.foundings), list(batch.foundings.values())),
+                        prepare=True,
                     )
 
-
-def get_region(nation: str) -> str | None:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT region FROM nations WHERE (name = %s)", (nation,))
-            region = cur.fetchone()
-            if region is not None:
-                return region[0]
-    return None
-
-
-def get_wa_status(nation: str) -> bool:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT wa_member FROM nations WHERE (name = %s)", (nation,))
-            wa_member = cur.fetchone()
-            if wa_member is not None:
-                return wa_member[0]
-    return False
-
-
-def get_endorsements(nation: str) -> list[str]:
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT endorsements FROM nations WHERE (name = %s)", (nation,))
-            endorsements = cur.fetchone()
-            if endorsements is not None:
-                return endorsements[0]
-    return []
+                for column, values in batch.columns.items():
+                    if values:
+                        await conn.execute(
+                            UPDATE_COLUMN[column],
+                            (list(values), list(values.values())),
+                            prepare=True,
+                        )
+
+                if batch.endorsements:
+                    await _apply_endorsements(conn, batch.endorsements)
+
+            if deltas is not None:
+                await _apply_region_deltas(conn, deltas, regions)
+
+
+async def _apply_endorsements(
+    conn: AsyncConnection, changes: dict[tuple[str, str], bool]
+) -> None:
+    for query, endorsed in ((ADD_ENDORSEMENTS, True), (REMOVE_ENDORSEMENTS, False)):
+        pairs = [pair for pair, value in changes.items() if value is endorsed]
+        if pairs:
+            endorsees, endorsers = zip(*pairs)
+            await conn.execute(query, (list(endorsees), list(endorsers)), prepare=True)
+
+
+async def _apply_region_deltas(
+    conn: AsyncConnection, deltas: "RegionDeltas", regions: set[str]
+) -> None:
+    # Unchanged regions are listed too, only to lock them for the recount.
+    names = sorted(deltas.changed() | regions)
+    if not names:
+        return
+    deposed = sorted(deltas.deposed)
+    await conn.execute(
+        UPSERT_REGIONS,
+        (
+            names,
+            [deltas.nations[name] for name in names],
+            [deltas.wa_members[name] for name in names],
+            [deltas.elected.get(name) for name in names],
+            [region for region, _ in deposed],
+            [nation for _, nation in deposed],
+        ),
+        prepare=True,
+    )
+    await conn.execute(COUNT_DELEGATE_ENDORSEMENTS, (names,), prepare=True)
+
+
+async def get_nations() -> AsyncIterator[tuple[str, str, bool, bool, bool]]:
+    """Stream every nation's name, region, wa_member, wa_delegate and active."""
+    async with pool.connection() as conn:
+        async with conn.cursor(name="nations") as cur:
+            cur.itersize = 10_000
+            await cur.execute(SELECT_NATIONS)
+            async for row in cur:
+                yield row
+
+
+async def find_nations(
+    names: list[str],
+) -> list[tuple[str, str, bool, bool, bool]]:
+    """Like get_nations, for just the named nations that exist."""
+    async with pool.connection() as conn:
+        cur = await conn.execute(FIND_NATIONS, (names,), prepare=True)
+        return await cur.fetchall()
+
+
+async def dumps_ingested() -> AsyncIterator[None]:
+    """Listen for the ingester loading dumps, yielding once listening starts and
+    after each dump is loaded."""
+    async with await AsyncConnection.connect(**DB_CONFIG, autocommit=True) as conn:
+        await conn.execute(f"LISTEN {REGION_CHANNEL}")
+        yield
+        async for notify in conn.notifies():
+            if not notify.payload:
+                yield
+
+
+async def get_last_dump_time() -> datetime | None:
+    """When the most recently ingested dump was generated."""
+    async with pool.connection() as conn:
+        cur = await conn.execute(SELECT_LAST_DUMP_TIME)
+        row = await cur.fetchone()
+        return row[0] if row else None
@@ -0,0 +1,218 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+import aiohttp
+
+import metrics
+from channels import Channel
+
+logger = logging.getLogger(__name__)
+
+USERNAME = "RWA Feed"
+AVATAR_URL = "https://files.dussud.org/NovaAohr/2560w1x1.png"
+MESSAGE_LIMIT = 2000
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+LOW_PRIORITY_LINGER = int(os.getenv("WEBHOOK_LOW_PRIORITY_LINGER_MS", 1000)) / 1000
+
+SEND_SECONDS = metrics.STAGE_SECONDS.labels("send")
+
+
+class Webhook:
+    """Queues and worker for a single webhook URL.
+
+    Messages are queued in a lane per priority. High-priority messages always go
+    out first. Low-priority ones are held for up to WEBHOOK_LOW_PRIORITY_LINGER_MS,
+    or until they fill a message, so they go out in fewer, fuller messages; when
+    their lane is full the oldest are dropped. Queued messages are packed into as
+    few Discord messages as the length limit allows, and sends wait out the
+    webhook's rate-limit bucket instead of running into 429s."""
+
+    def __init__(self, session: aiohttp.ClientSession, url: str):
+        self.session = session
+        self.url = url
+        # (channel name, content, when queued, when the event happened)
+        self._lanes: dict[str, deque[tuple[str, str, float, float | None]]] = {
+            "high": deque(),
+            "low": deque(maxlen=WEBHOOK_QUEUE_SIZE),
+        }
+        self._queued_chars = {"high": 0, "low": 0}
+        self._dropped = 0
+        self._ready = asyncio.Event()
+        self._send_now = asyncio.Event()
+        self._remaining: int | None = None
+        self._reset_at = 0.0
+
+    def put(
+        self, name: str, content: str, priority: str, happened_at: float | None = None
+    ) -> None:
+        """Queue content for the channel called name. happened_at is the unix time of
+        the event it reports, if known."""
+        if len(content) > MESSAGE_LIMIT:
+            logger.error(
+                f"Dropping message for channel [{name}]: longer than {MESSAGE_LIMIT} characters"
+            )
+            return
+        lane = self._lanes[priority]
+        if lane.maxlen is None and len(lane) >= WEBHOOK_QUEUE_SIZE:
+            logger.warning(f"Webhook queue for channel [{name}] full, dropping message")
+            metrics.WEBHOOK_DROPPED.labels(priority).inc()
+            return
+        if len(lane) == lane.maxlen:
+            # The append below pushes the oldest message out of the lane.
+            self._queued_chars[priority] -= len(lane[0][1]) + 1
+            self._dropped += 1
+            metrics.WEBHOOK_DROPPED.labels(priority).inc()
+        else:
+            metrics.WEBHOOK_QUEUE_DEPTH.labels(priority).inc()
+        lane.append((name, content, time.monotonic(), happened_at))
+        self._queued_chars[priority] += len(content) + 1
+        self._ready.set()
+        if self._worth_sending():
+            self._send_now.set()
+
+    def _pack(self, priority: str) -> tuple[str, str, list[float]]:
+        """Pop as many queued messages for the same channel as fit in one message,
+        returning the channel, the message and when the packed events happened."""
+        lane = self._lanes[priority]
+        now = time.monotonic()
+        name, content, queued_at, happened_at = lane.popleft()
+        parts, size, lags = [content], len(content), [now - queued_at]
+        happened = [happened_at]
+        while lane:
+            next_name, next_content, queued_at, happened_at = lane[0]
+            if next_name != name or size + 1 + len(next_content) > MESSAGE_LIMIT:
+                break
+            lane.popleft()
+            parts.append(next_content)
+            size += 1 + len(next_content)
+            lags.append(now - queued_at)
+            happened.append(happened_at)
+        self._queued_chars[priority] -= size + 1
+        metrics.WEBHOOK_QUEUE_DEPTH.labels(priority).dec(len(parts))
+        for lag in lags:
+            metrics.WEBHOOK_QUEUE_LAG.labels(priority).observe(lag)
+        return name, "\n".join(parts), [t for t in happened if t is not None]
+
+    async def _wait_for_bucket(self) -> None:
+        if self._remaining == 0 and (delay := self._reset_at - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def _update_bucket(self, headers) -> None:
+        if (remaining := headers.get("X-RateLimit-Remaining")) is not None:
+            self._remaining = int(remaining)
+        if (reset_after := headers.get("X-RateLimit-Reset-After")) is not None:
+            self._reset_at = time.monotonic() + float(reset_after)
+
+    async def _post(self, name: str, content: str, happened: list[float]) -> None:
+        payload = {
+            "content": content,
+            "username": f"{USERNAME} - {name}",
+            "avatar_url": AVATAR_URL,
+        }
+        while True:
+            await self._wait_for_bucket()
+            start_time = time.perf_counter()
+            try:
+                async with self.session.post(self.url, json=payload) as resp:
+                    self._update_bucket(resp.headers)
+                    SEND_SECONDS.observe(time.perf_counter() - start_time)
+                    if resp.status != 429:
+                        resp.raise_for_status()
+                        now = time.time()
+                        for happened_at in happened:
+                            metrics.DELIVERY_LAG.observe(now - happened_at)
+                        return
+                    metrics.WEBHOOK_RATE_LIMITED.inc()
+                    try:
+                        body = await resp.json()
+                    except aiohttp.ContentTypeError:
+                        body = {}
+                    retry_after = float(
+                        body.get("retry_after", resp.headers.get("Retry-After", 1))
+                    )
+            except Exception as e:
+                logger.error(f"Error sending message in channel [{name}]: {e}")
+                return
+            logger.warning(
+                f"Rate limited in channel [{name}], retrying in {retry_after:.2f}s"
+            )
+            self._remaining, self._reset_at = 0, time.monotonic() + retry_after
+
+    def _worth_sending(self) -> bool:
+        return bool(self._lanes["high"]) or self._queued_chars["low"] > MESSAGE_LIMIT
+
+    async def _linger(self) -> None:
+        """Hold low-priority messages back until they are old enough to send, fill a
+        message, or a high-priority message arrives."""
+        self._send_now.clear()
+        if self._worth_sending():
+            return
+        delay = self._lanes["low"][0][2] + LOW_PRIORITY_LINGER - time.monotonic()
+        if delay > 0:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._send_now.wait(), delay)
+
+    async def run(self) -> None:
+        while True:
+            if not any(self._lanes.values()):
+                self._ready.clear()
+                await self._ready.wait()
+            # Waiting out the bucket before packing lets a backlog go out in fewer
+            # messages.
+            await self._wait_for_bucket()
+            await self._linger()
+            if self._dropped:
+                logger.warning(
+                    f"Webhook falling behind, dropped {self._dropped} oldest low-priority messages"
+                )
+                self._dropped = 0
+            priority = "high" if self._lanes["high"] else "low"
+            await self._post(*self._pack(priority))
+
+
+class Delivery:
+    """Sends messages to channels over one long-lived HTTP session.
+
+    Each webhook gets its own queues and worker, so a rate-limited webhook only
+    holds up its own channels."""
+
+    def __init__(self):
+        self._session: aiohttp.ClientSession | None = None
+        self._webhooks: dict[str, Webhook] = {}
+        self._workers: list[asyncio.Task] = []
+
+    async def __aenter__(self) -> "Delivery":
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        self._webhooks.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def send(
+        self, channel: Channel, content: str, happened_at: datetime | None = None
+    ) -> None:
+        """Queue content for delivery to a channel without waiting for it to be sent.
+        happened_at is when the event it reports happened, if known."""
+        if self._session is None:
+            raise RuntimeError("Delivery is not open")
+        if (webhook := self._webhooks.get(channel.url)) is None:
+            webhook = self._webhooks[channel.url] = Webhook(self._session, channel.url)
+            self._workers.append(asyncio.create_task(webhook.run()))
+        webhook.put(
+            channel.name,
+            content,
+            channel.priority,
+            happened_at.timestamp() if happened_at else None,
+        )
@@ -0,0 +1,175 @@
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import time
+from collections.abc import Iterator
+from datetime import datetime, timezone
+
+from ns_event import NSEvent
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "../journal")
+JOURNAL_SEGMENT_BYTES = int(os.getenv("JOURNAL_SEGMENT_BYTES", 16 * 1024 * 1024))
+JOURNAL_RETENTION_DAYS = float(os.getenv("JOURNAL_RETENTION_DAYS", 7))
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", 600))
+
+SUFFIX = ".journal"
+
+
+def format_event(id: int | None, when: int, event_str: str) -> str:
+    """A journal line: an event's id, unix time and raw string, tab separated."""
+    return f"{'' if id is None else id}\t{when}\t{event_str}\n"
+
+
+def parse_event(line: str) -> dict:
+    """The raw event a complete journal line holds."""
+    id_, when, event_str = line[:-1].split("\t", 2)
+    return {
+        "id": int(id_) if id_ else None,
+        "time": datetime.fromtimestamp(int(when), timezone.utc),
+        "str": event_str,
+    }
+
+
+def segment_start(path: str) -> int:
+    """Unix time of the first event in a segment, from its file name."""
+    return int(os.path.basename(path).split("-", 1)[0])
+
+
+def list_segments(directory: str) -> list[str]:
+    """Every segment in the journal, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith((SUFFIX, SUFFIX + ".gz"))
+    )
+
+
+class Journal:
+    """Append-only, segmented log of every event the consumer applies.
+
+    Each line holds an event's id, unix time and raw string, tab separated.
+    Segments are named after the time of their first event so they sort in order,
+    and a new one is started every JOURNAL_SEGMENT_BYTES. compact() gzips closed
+    segments and deletes those older than JOURNAL_RETENTION_DAYS."""
+
+    def __init__(
+        self,
+        directory: str = JOURNAL_DIR,
+        segment_bytes: int = JOURNAL_SEGMENT_BYTES,
+        retention_days: float = JOURNAL_RETENTION_DAYS,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention = retention_days * 24 * 60 * 60
+        self._opened = False
+        self._file = None
+        self._size = 0
+
+    def open(self) -> None:
+        """Start journaling. Until then, and if JOURNAL_DIR is empty, appends are
+        ignored."""
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._opened = True
+            logger.info(f"Journaling events to {self.directory}")
+
+    def close(self) -> None:
+        self._close_segment()
+        self._opened = False
+
+    def _close_segment(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _new_segment(self, start: int) -> None:
+        self._close_segment()
+        seq = 0
+        while os.path.exists(
+            path := os.path.join(self.directory, f"{start:010d}-{seq:04d}{SUFFIX}")
+        ) or os.path.exists(path + ".gz"):
+            seq += 1
+        self._file = open(path, "ab")
+        self._size = 0
+
+    def append(self, event: NSEvent) -> None:
+        if not self._opened:
+            return
+        when = int(event.time.timestamp() if event.time else time.time())
+        if self._file is None or self._size >= self.segment_bytes:
+            self._new_segment(when)
+        line = format_event(event.id, when, event.str)
+        self._size += self._file.write(line.encode())  # type: ignore
+
+    async def sync(self) -> None:
+        """Make every event appended so far durable."""
+        if self._file is not None:
+            self._file.flush()
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+
+    async def compact(self) -> None:
+        # Listed here rather than in the worker thread, so a segment started while
+        # compacting is never mistaken for a closed one.
+        current = self._file.name if self._file is not None else None
+        segments = list_segments(self.directory)
+        cutoff = time.time() - self.retention
+        await asyncio.to_thread(self._compact, segments, current, cutoff)
+
+    def _compact(self, segments: list[str], current: str | None, cutoff: float) -> None:
+        removed = compressed = 0
+        for path, following in zip(segments, segments[1:] + [None]):
+            if path == current:
+                continue
+            # A segment ends where the next one starts.
+            if following is not None and segment_start(following) < cutoff:
+                os.remove(path)
+                removed += 1
+            elif path.endswith(SUFFIX):
+                with open(path, "rb") as src, gzip.open(path + ".gz.part", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(path + ".gz.part", path + ".gz")
+                os.remove(path)
+                compressed += 1
+        if removed or compressed:
+            logger.info(
+                f"Compacted journal: {compressed} segments compressed, {removed} removed"
+            )
+
+    async def run_compaction(self, interval: float = JOURNAL_COMPACT_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.compact()
+            except OSError as e:
+                logger.error(f"Error compacting journal: {e}")
+
+
+def read_journal(directory: str, since: datetime) -> Iterator[dict]:
+    """Yield the raw events journaled at or after since, in order."""
+    since_ts = since.timestamp()
+    segments = list_segments(directory)
+    # Start from the last segment that began before since.
+    first = max(
+        (i for i, path in enumerate(segments) if segment_start(path) <= since_ts),
+        default=0,
+    )
+    for path in segments[first:]:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # Torn write at the end of a segment.
+                event = parse_event(line)
+                if event["time"].timestamp() >= since_ts:
+                    yield event
+
+
+journal = Journal()
@@ -1,9 +1,16 @@
 import asyncio
 import logging
 import logging.handlers
+import time
 
-from channels import get_channels
+import db
+import metrics
+from cache import nations
+from channels import Channel, Router, watch_config
 from consumer import consume
+from delivery import Delivery
+from journal import journal
+from ns_event import NSEvent
 
 fmt = "[{asctime}] [{levelname:<8}] {name} - {message}"
 dt_fmt = "%Y-%m-%d %H:%M:%S"
@@ -23,20 +30,59 @@ formatter = logging.Formatter(fmt, dt_fmt, style="{")
 handler.setFormatter(formatter)
 logging.getLogger().addHandler(handler)
 
-channels = get_channels()
-if channels:
-    logger.info(
-        f"Loaded {len(channels)} channel{'s' if len(channels) > 1 else ''} from config: {[channel.name for channel in channels]}"
-    )
-else:
-    logger.info("No channels loaded.")
+
+def log_channels(channels: list[Channel]):
+    if channels:
+        logger.info(
+            f"Loaded {len(channels)} channel{'s' if len(channels) > 1 else ''} from config: {[channel.name for channel in channels]}"
+        )
+    else:
+        logger.info("No channels loaded.")
+
+
+router = Router.from_config()
+log_channels(router.channels)
+delivery = Delivery()
+
+
+async def reload_channels():
+    global router
+    async for new_router in watch_config():
+        router = new_router
+        log_channels(router.channels)
+
+
+route_seconds = metrics.STAGE_SECONDS.labels("route")
+
+
+async def deliver(event: NSEvent):
+    start_time = time.perf_counter()
+    channels = router.route(event)
+    route_seconds.observe(time.perf_counter() - start_time)
+    if channels:
+        content = str(event)
+        for channel in channels:
+            delivery.send(channel, content, event.time)
 
 
 async def main():
-    logger.info("Listening for events...")
-    for event in consume():
-        for channel in filter(lambda c: c.match(event), channels):
-            await channel.send(str(event))
+    metrics.serve()
+    async with db.pool, delivery:
+        metrics.watch_pool(db.pool)
+        loaded = asyncio.Event()
+        follower = asyncio.create_task(nations.follow_ingests(loaded))
+        await loaded.wait()
+        journal.open()
+        reloader = asyncio.create_task(reload_channels())
+        compactor = asyncio.create_task(journal.run_compaction())
+        logger.info("Listening for events...")
+        try:
+            await consume(deliver)
+        finally:
+            reloader.cancel()
+            follower.cancel()
+            compactor.cancel()
+            journal.close()
 
 
 if __name__ == "__main__":
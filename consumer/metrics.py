@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from psycopg_pool import AsyncConnectionPool
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+EVENTS = Counter("rwa_events", "Events received from the feed, by bucket", ["bucket"])
+STAGE_SECONDS = Histogram(
+    "rwa_stage_seconds",
+    "Time spent parsing an event, applying a batch, routing an event or sending a webhook request",
+    ["stage"],
+    buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5),
+)
+PIPELINE_QUEUE_DEPTH = Gauge(
+    "rwa_pipeline_queue_depth",
+    "Items waiting in the queues between the consumer's pipeline stages",
+    ["queue"],
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "rwa_db_pool_connections",
+    "Open and idle database pool connections, and requests waiting for one",
+    ["state"],
+)
+DELIVERY_LAG = Histogram(
+    "rwa_delivery_lag_seconds",
+    "Time from an event happening to it being posted to a webhook",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+WEBHOOK_QUEUE_DEPTH = Gauge(
+    "rwa_webhook_queue_depth",
+    "Messages waiting to be sent to webhooks, by priority",
+    ["priority"],
+)
+WEBHOOK_QUEUE_LAG = Histogram(
+    "rwa_webhook_queue_lag_seconds",
+    "Time messages spend queued before being sent, by priority",
+    ["priority"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+WEBHOOK_DROPPED = Counter(
+    "rwa_webhook_dropped_messages",
+    "Messages dropped because a webhook queue was full, by priority",
+    ["priority"],
+)
+WEBHOOK_RATE_LIMITED = Counter(
+    "rwa_webhook_rate_limited",
+    "Webhook requests answered with 429 Too Many Requests",
+)
+SSE_RECONNECT_SECONDS = Histogram(
+    "rwa_sse_reconnect_seconds",
+    "Time from the SSE feed dropping to receiving events again",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+SSE_BACKFILL_SECONDS = Histogram(
+    "rwa_sse_backfill_seconds",
+    "Time spent backfilling missed events from the happenings API after a reconnect",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+SSE_BACKFILLED_EVENTS = Counter(
+    "rwa_sse_backfilled_events",
+    "Events recovered from the happenings API after the SSE feed dropped",
+)
+
+
+def watch_queue(name: str, queue: asyncio.Queue) -> None:
+    PIPELINE_QUEUE_DEPTH.labels(name).set_function(queue.qsize)
+
+
+def watch_pool(pool: AsyncConnectionPool) -> None:
+    for state, stat in (
+        ("open", "pool_size"),
+        ("idle", "pool_available"),
+        ("waiting", "requests_waiting"),
+    ):
+        DB_POOL_CONNECTIONS.labels(state).set_function(
+            lambda stat=stat: pool.get_stats().get(stat, 0)
+        )
+
+
+def serve() -> None:
+    """Serve metrics over HTTP if METRICS_PORT is set."""
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+        logger.info(f"Serving metrics on port {METRICS_PORT}")
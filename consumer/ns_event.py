@@ -1,3 +1,5 @@
+import re
+from datetime import datetime
 from enum import Enum
 
 class EventType(Enum):
@@ -18,55 +20,82 @@ class EventType(Enum):
 
     @staticmethod
     def event_type_from_str(event_str: str):
-        parts = event_str.split()
-        for event_type in EventType:
-            if " ".join(parts[1:]).startswith(event_type.value):
-                return event_type
-        raise ValueError(f"Unknown event type in string: {event_str}")
-    
+        if (match := EVENT_PATTERN.match(event_str)) is None:
+            raise ValueError(f"Unknown event type in string: {event_str}")
+        return EVENT_TYPES[match[2]]
+
     def get_bucket(self) -> str:
-        return self.name.lower().split('_')[0]
-
-
-PARAMETER_POSITIONS: dict[EventType, tuple[int, ...]] = {
-    # EventType.EJECT: (4, 6),
-    # EventType.EJECT_BANNED: (6, 8),
-    EventType.MOVE: (3, 5),
-    EventType.FOUNDING: (4,),
-    EventType.FOUNDING_REFOUND: (4,),
-    EventType.CTE: (5,),
-    EventType.MEMBER_APPLY: (),
-    EventType.MEMBER_ADMIT: (),
-    EventType.MEMBER_RESIGN: (),
-    EventType.MEMBER_DELEGATE: (5,),
-    EventType.MEMBER_DELEGATE_SEIZED: (5, 9),
-    EventType.MEMBER_DELEGATE_LOST: (6,),
-    EventType.ENDO: (2,),
-    EventType.ENDO_WITHDRAW: (5,),
+        return BUCKETS[self]
+
+
+EVENT_TYPES = {event_type.value: event_type for event_type in EventType}
+BUCKETS = {event_type: event_type.name.lower().split("_")[0] for event_type in EventType}
+
+# The acting nation, then the phrase that identifies the event type.
+EVENT_PATTERN = re.compile(
+    r"@@([^@\s]+)@@ ("
+    + "|".join(re.escape(value) for value in sorted(EVENT_TYPES, key=len, reverse=True))
+    + r")\b"
+)
+# Nations and regions named in an event, without any punctuation that follows.
+NAME_PATTERN = re.compile(r"@@([^@\s]+)@@|%%([^%\s]+)%%")
+
+# Number of names, after the acting nation, that are parameters of each event type.
+PARAMETER_COUNTS: dict[EventType, int] = {
+    # EventType.EJECT: 2,
+    # EventType.EJECT_BANNED: 2,
+    EventType.MOVE: 2,
+    EventType.FOUNDING: 1,
+    EventType.FOUNDING_REFOUND: 1,
+    EventType.CTE: 1,
+    EventType.MEMBER_APPLY: 0,
+    EventType.MEMBER_ADMIT: 0,
+    EventType.MEMBER_RESIGN: 0,
+    EventType.MEMBER_DELEGATE: 1,
+    EventType.MEMBER_DELEGATE_SEIZED: 2,
+    EventType.MEMBER_DELEGATE_LOST: 1,
+    EventType.ENDO: 1,
+    EventType.ENDO_WITHDRAW: 1,
 }
 
 
+def _link(match: re.Match) -> str:
+    nation, region = match.groups()
+    if nation is not None:
+        return f"[{nation.title().replace('_', ' ')}](https://nationstates.net/nation={nation})"
+    return f"[{region.title().replace('_', ' ')}](https://nationstates.net/region={region})"
+
+
 class NSEvent:
-    def __init__(self, event_str: str):
+    """An event parsed from its string in a single pass.
+
+    The Markdown rendering returned by str() is only built when first asked for,
+    then cached, as most events are never delivered anywhere."""
+
+    __slots__ = ("str", "id", "time", "nation", "event_type", "bucket", "parameters", "_markdown")
+
+    def __init__(
+        self, event_str: str, id: int | None = None, time: datetime | None = None
+    ):
         self.str = event_str
-        parts = event_str.split()
-        self.nation = parts[0][2:-2]
-        self.event_type = EventType.event_type_from_str(event_str)
+        self.id = id
+        self.time = time
+        if (match := EVENT_PATTERN.match(event_str)) is None:
+            raise ValueError(f"Unknown event type in string: {event_str}")
+        self.nation = match[1]
+        self.event_type = EVENT_TYPES[match[2]]
+        self.bucket = BUCKETS[self.event_type]
+        count = PARAMETER_COUNTS[self.event_type]
         self.parameters = [
-            parts[i][2:-2] for i in PARAMETER_POSITIONS.get(self.event_type, ())
+            nation or region
+            for nation, region in NAME_PATTERN.findall(event_str, match.end())[:count]
         ]
+        self._markdown: str | None = None
 
     def __repr__(self) -> str:
         return f"<NSEvent nation='{self.nation}' event_type={self.event_type}{f' parameters={self.parameters}' if self.parameters else ''}>"
-    
+
     def __str__(self) -> str:
-        parts = self.str.split()
-        parts[0] = f"[{self.nation.title().replace('_', ' ')}](https://nationstates.net/nation={self.nation})"
-        match self.event_type:
-            case EventType.MOVE | EventType.FOUNDING | EventType.FOUNDING_REFOUND | EventType.CTE:
-                other_type = "region"
-            case _:
-                other_type = "nation"
-        for i, param in zip(PARAMETER_POSITIONS.get(self.event_type, ()), self.parameters):
-            parts[i] = f"[{param.title().replace('_', ' ')}](https://nationstates.net/{other_type}={param})"
-        return " ".join(parts)
\ No newline at end of file
+        if self._markdown is None:
+            self._markdown = NAME_PATTERN.sub(_link, self.str)
+        return self._markdown
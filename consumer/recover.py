@@ -0,0 +1,64 @@
+"""Replay journaled events into the database.
+
+Restores the state the consumer had built up since the last ingested dump: ingest
+the dump, then run this with the consumer stopped to re-apply every event
+journaled from the dump's time onward through the usual batched path."""
+
+import argparse
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from datetime import datetime
+
+import db
+from cache import nations
+from consumer import RawEvent, consume
+from journal import JOURNAL_DIR, read_journal
+from ns_event import NSEvent
+
+fmt = "[{asctime}] [{levelname:<8}] {name} - {message}"
+dt_fmt = "%Y-%m-%d %H:%M:%S"
+logging.basicConfig(format=fmt, datefmt=dt_fmt, style="{", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def journaled_events(since: datetime) -> AsyncIterator[RawEvent]:
+    for event in read_journal(JOURNAL_DIR, since):
+        yield event
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--since",
+        type=datetime.fromisoformat,
+        help="replay events from this ISO 8601 time instead of the last dump's",
+    )
+    args = parser.parse_args()
+
+    async with db.pool:
+        since = args.since or await db.get_last_dump_time()
+        if since is None:
+            raise SystemExit("No dump has been ingested yet, pass --since.")
+        if since.tzinfo is None:
+            since = since.astimezone()
+        # Region deltas and notifications are worked out from the cached nations.
+        await nations.load()
+
+        logger.info(f"Replaying events journaled since {since.isoformat()}...")
+        start_time = time.perf_counter()
+        replayed = 0
+
+        async def count(event: NSEvent) -> None:
+            nonlocal replayed
+            replayed += 1
+
+        await consume(count, journaled_events(since))
+        logger.info(
+            f"Replayed {replayed} events. ({time.perf_counter() - start_time:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
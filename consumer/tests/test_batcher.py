@@ -0,0 +1,378 @@
+"""Checks that applying events in batches gives the same database as applying them
+one at a time, and keeps the regions table as the ingester would rebuild it.
+
+The database is faked in memory, written the way the statements in db.py write the
+nations, endorsements and regions tables, and events are generated at random over a few
+small regions, so writes to the same nations often land in the same batch."""
+
+import asyncio
+import random
+from collections.abc import Callable
+
+import pytest
+
+import db
+from batcher import BatchWriter, EventBatch, RegionDeltas, ShardedWriter
+from cache import ACTIVE, WA_DELEGATE, WA_MEMBER, nations
+from ns_event import NSEvent
+
+REGIONS = ("alpha", "beta", "gamma")
+NATIONS = 30
+EVENTS = 400
+KINDS = (
+    "move",
+    "founding",
+    "refounding",
+    "cte",
+    "admit",
+    "resign",
+    "delegate",
+    "seize",
+    "lost",
+    "endo",
+    "endo",
+    "endo",
+    "withdraw",
+    "leave",
+    "ghost",
+)
+
+
+def new_row(region: str, wa_member: bool = False) -> dict:
+    return {
+        "region": region,
+        "wa_member": wa_member,
+        "wa_delegate": False,
+        "active": True,
+    }
+
+
+class FakeDatabase:
+    def __init__(self, seed: int):
+        rng = random.Random(seed)
+        self.nations: dict[str, dict] = {}
+        self.endorsements: set[tuple[str, str]] = set()  # (endorsee, endorser)
+        for i in range(NATIONS):
+            self.nations[f"nation_{i}"] = new_row(
+                rng.choice(REGIONS), wa_member=rng.random() < 0.6
+            )
+        members = [name for name, row in self.nations.items() if row["wa_member"]]
+        for region in REGIONS:
+            local = [name for name in members if self.nations[name]["region"] == region]
+            if local:
+                self.nations[local[0]]["wa_delegate"] = True
+            for endorser in local:
+                for endorsee in rng.sample(local, len(local) // 2):
+                    if endorsee != endorser:
+                        self.endorsements.add((endorsee, endorser))
+        self.regions = self.rebuilt_regions()
+
+    def copy(self) -> "FakeDatabase":
+        database = object.__new__(FakeDatabase)
+        database.nations = {name: dict(row) for name, row in self.nations.items()}
+        database.endorsements = set(self.endorsements)
+        database.regions = {name: dict(row) for name, row in self.regions.items()}
+        return database
+
+    async def apply_batches(
+        self, batches: list[EventBatch], regions=(), deltas=None
+    ) -> None:
+        await asyncio.sleep(0)  # let other writers in between transactions
+        for batch in batches:
+            self.apply_batch(batch)
+        if deltas is not None:
+            self.apply_region_deltas(deltas, set(regions))
+
+    def apply_batch(self, batch: EventBatch) -> None:
+        for name, region in batch.foundings.items():
+            row = self.nations.setdefault(name, new_row(region))
+            row.update(region=region, wa_member=False, active=True)
+        for column, values in batch.columns.items():
+            for name, value in values.items():
+                if name in self.nations:
+                    self.nations[name][column] = value
+        added = [pair for pair, endorsed in batch.endorsements.items() if endorsed]
+        # Placeholders are only inserted for endorsees missing when the statement
+        # starts, in the region their endorser had then.
+        existing = dict(self.nations)
+        for endorsee, endorser in added:
+            if endorsee not in existing and endorser in existing:
+                self.nations.setdefault(
+                    endorsee, new_row(existing[endorser]["region"], wa_member=True)
+                )
+        self.endorsements.update(added)
+        self.endorsements.difference_update(
+            pair for pair, endorsed in batch.endorsements.items() if not endorsed
+        )
+
+    def apply_region_deltas(self, deltas: RegionDeltas, regions: set[str]) -> None:
+        for name in sorted(deltas.changed() | regions):
+            nations, wa_members = deltas.nations[name], deltas.wa_members[name]
+            elected = deltas.elected.get(name)
+            if (row := self.regions.get(name)) is None:
+                row = self.regions[name] = {
+                    "nations": nations,
+                    "wa_members": wa_members,
+                    "delegate": elected,
+                }
+            else:
+                row["nations"] += nations
+                row["wa_members"] += wa_members
+                if elected is not None:
+                    row["delegate"] = elected
+                elif (name, row["delegate"]) in deltas.deposed:
+                    row["delegate"] = None
+            row["delegate_endorsements"] = self.endorsement_count(row["delegate"])
+
+    def endorsement_count(self, nation: str | None) -> int:
+        return sum(endorsee == nation for endorsee, _ in self.endorsements)
+
+    def rebuilt_regions(self) -> dict[str, dict]:
+        """The regions table as the ingester rebuilds it from the nations table."""
+        regions: dict[str, dict] = {}
+        for name, row in sorted(self.nations.items()):
+            region = regions.setdefault(
+                row["region"], {"nations": 0, "wa_members": 0, "delegate": None}
+            )
+            if row["active"]:
+                region["nations"] += 1
+                region["wa_members"] += row["wa_member"]
+                if row["wa_delegate"] and region["delegate"] is None:
+                    region["delegate"] = name
+        for region in regions.values():
+            region["delegate_endorsements"] = self.endorsement_count(region["delegate"])
+        return regions
+
+    def rows(self) -> list[tuple[str, str, bool, bool, bool]]:
+        return [
+            (name, row["region"], row["wa_member"], row["wa_delegate"], row["active"])
+            for name, row in self.nations.items()
+        ]
+
+    async def get_nations(self):
+        for row in self.rows():
+            yield row
+
+    async def find_nations(self, names: list[str]):
+        await asyncio.sleep(0)
+        return [row for row in self.rows() if row[0] in names]
+
+
+def generate_events(database: FakeDatabase, seed: int) -> list[NSEvent]:
+    """Events as the feed could send them for the database: delegates lose the
+    position before they move, resign or cease to exist."""
+    rng = random.Random(seed)
+    model = database.copy()
+    events: list[str] = []
+
+    def lose(nation: str) -> None:
+        if model.nations[nation]["wa_delegate"]:
+            region = model.nations[nation]["region"]
+            events.append(f"@@{nation}@@ lost WA Delegate status in %%{region}%%.")
+            model.nations[nation]["wa_delegate"] = False
+
+    while len(events) < EVENTS:
+        active = sorted(name for name, row in model.nations.items() if row["active"])
+        members = [name for name in active if model.nations[name]["wa_member"]]
+        delegates = {
+            model.nations[name]["region"]: name
+            for name in members
+            if model.nations[name]["wa_delegate"]
+        }
+        kind = rng.choice(KINDS)
+        nation = rng.choice(active)
+        row = model.nations[nation]
+        region = row["region"]
+        local = [name for name in members if model.nations[name]["region"] == region]
+        match kind:
+            case "move":
+                lose(nation)
+                destination = rng.choice(REGIONS)
+                events.append(
+                    f"@@{nation}@@ relocated from %%{region}%% to %%{destination}%%."
+                )
+                row["region"] = destination
+            case "founding":
+                founded = f"founded_{len(events)}"
+                events.append(f"@@{founded}@@ was founded in %%{region}%%.")
+                model.nations[founded] = new_row(region)
+            case "refounding":
+                inactive = [n for n, r in model.nations.items() if not r["active"]]
+                if inactive:
+                    nation = rng.choice(sorted(inactive))
+                    events.append(f"@@{nation}@@ was refounded in %%{region}%%.")
+                    model.nations[nation].update(
+                        region=region, wa_member=False, active=True
+                    )
+            case "cte":
+                lose(nation)
+                events.append(f"@@{nation}@@ ceased to exist in %%{region}%%.")
+                row["active"] = False
+            case "admit" if not row["wa_member"]:
+                events.append(f"@@{nation}@@ was admitted to the World Assembly.")
+                row["wa_member"] = True
+            case "resign" if row["wa_member"]:
+                lose(nation)
+                events.append(f"@@{nation}@@ resigned from the World Assembly.")
+                row["wa_member"] = False
+            case "delegate" if local and region not in delegates:
+                elected = rng.choice(local)
+                events.append(f"@@{elected}@@ became WA Delegate of %%{region}%%.")
+                model.nations[elected]["wa_delegate"] = True
+            case "seize" if region in delegates and len(local) > 1:
+                deposed = delegates[region]
+                seizer = rng.choice([name for name in local if name != deposed])
+                events.append(
+                    f"@@{seizer}@@ seized the position of %%{region}%% WA Delegate from @@{deposed}@@."
+                )
+                model.nations[deposed]["wa_delegate"] = False
+                model.nations[seizer]["wa_delegate"] = True
+            case "lost" if region in delegates:
+                lose(delegates[region])
+            case "endo" if len(local) > 1:
+                endorser, endorsee = rng.sample(local, 2)
+                if (endorsee, endorser) not in model.endorsements:
+                    events.append(f"@@{endorser}@@ endorsed @@{endorsee}@@.")
+                    model.endorsements.add((endorsee, endorser))
+            case "withdraw" if model.endorsements:
+                endorsee, endorser = rng.choice(sorted(model.endorsements))
+                events.append(
+                    f"@@{endorser}@@ withdrew its endorsement from @@{endorsee}@@."
+                )
+                model.endorsements.discard((endorsee, endorser))
+            case "leave":
+                # Moving away, then withdrawing endorsements left behind.
+                lose(nation)
+                destination = rng.choice([name for name in REGIONS if name != region])
+                events.append(
+                    f"@@{nation}@@ relocated from %%{region}%% to %%{destination}%%."
+                )
+                row["region"] = destination
+                for endorsee, endorser in sorted(model.endorsements):
+                    if endorser == nation:
+                        events.append(
+                            f"@@{nation}@@ withdrew its endorsement from @@{endorsee}@@."
+                        )
+                        model.endorsements.discard((endorsee, endorser))
+            case "ghost" if local:
+                # Endorsing a nation the database doesn't have yet.
+                endorser, endorsee = rng.choice(local), f"ghost_{len(events)}"
+                events.append(f"@@{endorser}@@ endorsed @@{endorsee}@@.")
+                model.nations[endorsee] = new_row(region, wa_member=True)
+                model.endorsements.add((endorsee, endorser))
+    return [NSEvent(event, i) for i, event in enumerate(events)]
+
+
+def serially(database: FakeDatabase, events: list[NSEvent]) -> FakeDatabase:
+    """The database after applying each event in a batch of its own."""
+    database = database.copy()
+    for event in events:
+        batch = EventBatch()
+        assert batch.add(event)
+        database.apply_batch(batch)
+    return database
+
+
+def use_database(seed: int, monkeypatch: pytest.MonkeyPatch) -> FakeDatabase:
+    """A fake database for the consumer to write to, with the nation cache loaded
+    from it."""
+    database = FakeDatabase(seed)
+    for name in ("apply_batches", "get_nations", "find_nations"):
+        monkeypatch.setattr(db, name, getattr(database, name))
+    nations.__init__()
+    asyncio.run(nations.load())
+    return database
+
+
+def assert_same(database: FakeDatabase, expected: FakeDatabase) -> None:
+    assert database.nations == expected.nations
+    assert database.endorsements == expected.endorsements
+
+
+async def write_batched(
+    events: list[NSEvent],
+    max_events: int,
+    check: Callable[[], None] = lambda: None,
+) -> None:
+    """Apply events through a BatchWriter, checking the database after each flush."""
+    writer = BatchWriter(max_events, max_latency=60)
+    for event in events:
+        writer.add(event)
+        if writer.full():
+            await writer.flush()
+            check()
+    await writer.flush()
+    check()
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("max_events", [1, 10, 100, EVENTS])
+def test_batches_match_serial(seed: int, max_events: int, monkeypatch):
+    database = use_database(seed, monkeypatch)
+    events = generate_events(database, seed)
+    expected = serially(database, events)
+    asyncio.run(write_batched(events, max_events))
+    assert_same(database, expected)
+
+
+def cached(row: dict) -> tuple[str, int]:
+    """A nations table row as the nation cache holds it."""
+    return row["region"], (
+        (WA_MEMBER if row["wa_member"] else 0)
+        | (WA_DELEGATE if row["wa_delegate"] else 0)
+        | (ACTIVE if row["active"] else 0)
+    )
+
+
+def occupied(regions: dict[str, dict]) -> dict[str, dict]:
+    """Regions with any nations, WA members or a delegate."""
+    return {
+        name: row
+        for name, row in regions.items()
+        if row["nations"] or row["wa_members"] or row["delegate"]
+    }
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("max_events", [1, 10, 100, EVENTS])
+def test_region_deltas_match_rebuild(seed: int, max_events: int, monkeypatch):
+    database = use_database(seed, monkeypatch)
+
+    def check() -> None:
+        assert occupied(database.regions) == occupied(database.rebuilt_regions())
+        # The nation cache the deltas are worked out from follows the nations table.
+        assert {name: nations.state(name) for name in database.nations} == {
+            name: cached(row) for name, row in database.nations.items()
+        }
+
+    asyncio.run(write_batched(generate_events(database, seed), max_events, check))
+
+
+async def write_sharded(
+    events: list[NSEvent], shards: int, max_events: int
+) -> list[NSEvent]:
+    """Apply events through a ShardedWriter, returning them as it forwards them."""
+    writer = ShardedWriter(shards, max_events=max_events, max_latency=60)
+    inp: asyncio.Queue[NSEvent | None] = asyncio.Queue()
+    out: asyncio.Queue[NSEvent | None] = asyncio.Queue()
+    for event in events:
+        inp.put_nowait(event)
+    inp.put_nowait(None)
+    await writer.run(inp, out)
+    applied = []
+    while (event := out.get_nowait()) is not None:
+        applied.append(event)
+    return applied
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("shards", [2, 4])
+@pytest.mark.parametrize("max_events", [10, 100])
+def test_shards_match_serial(seed: int, shards: int, max_events: int, monkeypatch):
+    database = use_database(seed, monkeypatch)
+    events = generate_events(database, seed)
+    expected = serially(database, events)
+    applied = asyncio.run(write_sharded(events, shards, max_events))
+    assert sorted(event.id for event in applied) == [event.id for event in events]
+    assert_same(database, expected)
+    assert occupied(database.regions) == occupied(database.rebuilt_regions())
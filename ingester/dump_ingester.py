@@ -1,11 +1,23 @@
+import argparse
+import gzip
+import hashlib
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import threading
 import time
+import zlib
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from xml.etree.ElementTree import XMLPullParser
 
 import sans
 import psycopg
+from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
 
 fmt = "[{asctime}] [{levelname:<8}] {name} - {message}"
 dt_fmt = "%Y-%m-%d %H:%M:%S"
@@ -33,102 +45,473 @@ if USER_AGENT is None:
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "db")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
 
 DB_CONFIG = {
-    "host": "db",
-    "port": 5432,
+    "host": POSTGRES_HOST,
+    "port": POSTGRES_PORT,
     "dbname": POSTGRES_DB,
     "user": POSTGRES_USER,
     "password": POSTGRES_PASSWORD,
 }
 
 
+DUMP_CACHE_DIR = os.getenv("DUMP_CACHE_DIR", "../dumps")
+# Where to write metrics in Prometheus' text format, for node_exporter's textfile
+# collector, as the ingester exits before it could be scraped.
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")
+
+registry = CollectorRegistry()
+PHASE_ROWS = Gauge(
+    "rwa_ingester_rows",
+    "Rows handled by each phase of the last ingest",
+    ["phase"],
+    registry=registry,
+)
+PHASE_SECONDS = Gauge(
+    "rwa_ingester_seconds",
+    "Duration of each phase of the last ingest",
+    ["phase"],
+    registry=registry,
+)
+PHASE_ROWS_PER_SECOND = Gauge(
+    "rwa_ingester_rows_per_second",
+    "Throughput of each phase of the last ingest",
+    ["phase"],
+    registry=registry,
+)
+SUCCEEDED = Gauge(
+    "rwa_ingester_succeeded",
+    "Whether the last ingest succeeded",
+    registry=registry,
+)
+
+# Pipeline queue bounds: dump chunks of CHUNK_SIZE bytes, and batches of
+# ROW_BATCH_SIZE rows.
+CHUNK_SIZE = 64 * 1024
+CHUNK_QUEUE_SIZE = 64
+ROW_QUEUE_SIZE = 16
+ROW_BATCH_SIZE = 1000
+
+
 def to_snake_case(s: str) -> str:
     return s.lower().replace(" ", "_")
 
 
-def main():
-    initial_time = time.time()
-    sans.set_agent(USER_AGENT) # type: ignore
+# Parsed nations are streamed into a staging table, then merged into nations in
+# set-based statements. Temporary tables are never WAL-logged.
+CREATE_STAGING = """CREATE TEMPORARY TABLE nations_staging (
+                    name text NOT NULL,
+                    fullname text,
+                    region text NOT NULL,
+                    wa_member boolean NOT NULL,
+                    wa_delegate boolean NOT NULL,
+                    flag text,
+                    endorsements text[] NOT NULL,
+                    fingerprint bigint NOT NULL
+                ) ON COMMIT DROP"""
+COPY_STAGING = """COPY nations_staging
+                (name, fullname, region, wa_member, wa_delegate, flag, endorsements,
+                fingerprint)
+                FROM STDIN"""
+# Only nations whose content differs from the last dump are written, unless the
+# ingest is a full one.
+SELECT_CHANGED = """CREATE TEMPORARY TABLE nations_changed ON COMMIT DROP AS
+                SELECT s.* FROM nations_staging AS s
+                LEFT JOIN dump_fingerprints AS f ON f.name = s.name
+                WHERE %(full)s OR f.fingerprint IS DISTINCT FROM s.fingerprint"""
+MERGE_NATIONS = """WITH merged AS (
+                    INSERT INTO nations (name, fullname, region, wa_member, wa_delegate, flag, active, updated_at)
+                    SELECT name, fullname, region, wa_member, wa_delegate, flag, TRUE, %(dump_time)s
+                    FROM nations_changed
+                    ON CONFLICT (name) DO UPDATE
+                    SET fullname     = EXCLUDED.fullname,
+                        region       = EXCLUDED.region,
+                        wa_member    = EXCLUDED.wa_member,
+                        wa_delegate  = EXCLUDED.wa_delegate,
+                        flag         = EXCLUDED.flag,
+                        active       = TRUE
+                    WHERE %(full)s OR nations.updated_at < EXCLUDED.updated_at
+                    RETURNING xmax = 0 AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+                FROM merged"""
+# Replace the endorsements of every changed nation the dump was written to:
+# inserted rows carry the dump time, updated ones are stamped now().
+DELETE_ENDORSEMENTS = """DELETE FROM endorsements AS e
+                USING nations_changed AS c JOIN nations AS n ON n.name = c.name
+                WHERE e.endorsee = c.name AND n.updated_at IN (now(), %(dump_time)s)"""
+INSERT_ENDORSEMENTS = """INSERT INTO endorsements (endorser, endorsee)
+                SELECT DISTINCT unnest(c.endorsements), c.name
+                FROM nations_changed AS c JOIN nations AS n ON n.name = c.name
+                WHERE n.updated_at IN (now(), %(dump_time)s)
+                ON CONFLICT DO NOTHING"""
+# Nations skipped because the database is newer are compared again next time.
+UPSERT_FINGERPRINTS = """INSERT INTO dump_fingerprints (name, fingerprint)
+                SELECT c.name, c.fingerprint
+                FROM nations_changed AS c JOIN nations AS n ON n.name = c.name
+                WHERE n.updated_at IN (now(), %(dump_time)s)
+                ON CONFLICT (name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint"""
+DELETE_FINGERPRINTS = """DELETE FROM dump_fingerprints AS f
+                WHERE NOT EXISTS (
+                    SELECT FROM nations_staging AS s WHERE s.name = f.name
+                )"""
+# Nations that haven't been touched since the dump was generated and aren't in it
+# have ceased to exist. This stamps them with now(), so it runs after endorsements.
+MARK_INACTIVE = """UPDATE nations SET active = FALSE
+                WHERE active AND (%(full)s OR updated_at < %(dump_time)s)
+                AND NOT EXISTS (
+                    SELECT FROM nations_staging AS s WHERE s.name = nations.name
+                )"""
+# Region aggregates are rebuilt from scratch. Locking out the consumer's writes
+# until commit keeps them from being applied to counts that already include them.
+LOCK_REGIONS = "LOCK TABLE regions IN EXCLUSIVE MODE"
+DELETE_REGIONS = "DELETE FROM regions"
+REBUILD_REGIONS = """INSERT INTO regions (name, nations, wa_members, delegate, delegate_endorsements)
+                SELECT r.*, (SELECT count(*) FROM endorsements AS e WHERE e.endorsee = r.delegate)
+                FROM (
+                    SELECT region,
+                        count(*) FILTER (WHERE active),
+                        count(*) FILTER (WHERE active AND wa_member),
+                        min(name) FILTER (WHERE active AND wa_delegate)
+                    FROM nations GROUP BY region
+                ) AS r (name, nations, wa_members, delegate)"""
+RECORD_DUMP = """INSERT INTO ingested_dumps (dump_time) VALUES (%(dump_time)s)
+                ON CONFLICT (dump_time) DO UPDATE SET ingested_at = now()"""
+# Sent on commit. With no regions named, listeners drop everything they have cached.
+NOTIFY_REGION_CHANGES = "NOTIFY region_changes"
 
-    #### EXTRACT AND PARSE DUMP ####
-    start_time = time.time()
-    logger.info("Parsing dump...")
 
-    dump_time = datetime.now(timezone.utc).replace(
-        hour=5, minute=30, second=0, microsecond=0
+def fingerprint(*fields: str | bool) -> int:
+    """64-bit hash of a nation's dump content, as a signed bigint."""
+    digest = hashlib.blake2b(
+        "\x1f".join(map(str, fields)).encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, signed=True)
+
+
+def parse_nation(nation) -> tuple[str, str, str, bool, bool, str, list[str], int]:
+    """Turn a dump NATION element into a staging row."""
+    current_nation = {}
+    for child in nation:
+        match child.tag:
+            case "UNSTATUS":
+                current_nation["wa_member"] = child.text in ("WA Delegate", "WA Member")
+                current_nation["wa_delegate"] = child.text == "WA Delegate"
+            case "ENDORSEMENTS":
+                current_nation["endorsements"] = (
+                    list(map(to_snake_case, child.text.split(",")))
+                    if child.text
+                    else []
+                )
+            case "NAME" | "FULLNAME" | "REGION" | "FLAG":
+                current_nation[child.tag.lower()] = child.text if child.text else ""
+
+    row = (
+        to_snake_case(current_nation["name"]),
+        current_nation["fullname"],
+        to_snake_case(current_nation["region"]),
+        current_nation["wa_member"],
+        current_nation["wa_delegate"],
+        current_nation["flag"],
     )
+    endorsements = current_nation["endorsements"]
+    return (*row, endorsements, fingerprint(*row, ",".join(sorted(endorsements))))
+
+
+def put(q: queue.Queue, item, stop: threading.Event) -> None:
+    """Put item on a bounded queue, giving up once the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def get(q: queue.Queue, stop: threading.Event):
+    """Get the next item from a queue, or None once the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def read_dump(
+    chunks: Iterable[bytes], out: queue.Queue, stop: threading.Event
+) -> float:
+    """Source stage: pass decompressed dump chunks into out, returning busy time."""
+    busy = 0.0
+    try:
+        start_time = time.perf_counter()
+        for chunk in chunks:
+            busy += time.perf_counter() - start_time
+            put(out, chunk, stop)
+            if stop.is_set():
+                break
+            start_time = time.perf_counter()
+    finally:
+        put(out, None, stop)
+    return busy
+
+
+def iter_file(path: str) -> Iterator[bytes]:
+    """Decompressed chunks of a local .xml.gz dump."""
+    with gzip.open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def file_time(path: str) -> datetime:
+    return datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc)
+
+
+class DumpCache:
+    """The last downloaded dump, kept compressed on disk with the validators needed
+    to fetch the next one conditionally."""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "nations.xml.gz")
+        self.meta_path = os.path.join(directory, "nations.json")
+        self.meta: dict[str, str | bool] = {}
+        if os.path.exists(self.path) and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+
+    def validators(self) -> dict[str, str]:
+        """Conditional request headers for the cached dump."""
+        headers = {}
+        if etag := self.meta.get("etag"):
+            headers["If-None-Match"] = str(etag)
+        if last_modified := self.meta.get("last_modified"):
+            headers["If-Modified-Since"] = str(last_modified)
+        return headers
+
+    def _save_meta(self) -> None:
+        with open(self.meta_path + ".part", "w") as f:
+            json.dump(self.meta, f)
+        os.replace(self.meta_path + ".part", self.meta_path)
+
+    def download(self, response: sans.Response) -> Iterator[bytes]:
+        """Decompressed chunks of a downloaded dump, saved to the cache as they
+        arrive. The cached copy is only replaced once the download completes."""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(self.path + ".part", "wb") as f:
+            for chunk in response.iter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+                yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+        last_modified = response.headers.get("Last-Modified")
+        if last_modified:
+            # Stamp the file with the dump time, so it can be ingested offline.
+            mtime = parsedate_to_datetime(last_modified).timestamp()
+            os.utime(self.path + ".part", (mtime, mtime))
+        os.replace(self.path + ".part", self.path)
+        self.meta = {
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": last_modified or "",
+            "ingested": False,
+        }
+        self._save_meta()
 
-    nations: list[dict[str, str | bool | list[str] | datetime]] = []
-    with sans.stream("GET", sans.NationsDump()) as response:
-        for nation in response.iter_xml():
-            sans.indent(nation)
-
-            current_nation = {}
-            for child in nation:
-                match child.tag:
-                    case "UNSTATUS":
-                        match child.text:
-                            case "WA Delegate":
-                                current_nation["wa_delegate"] = True
-                                current_nation["wa_member"] = True
-                            case "WA Member":
-                                current_nation["wa_member"] = True
-                            case _:
-                                current_nation["wa_delegate"] = False
-                                current_nation["wa_member"] = False
-                    case "ENDORSEMENTS":
-                        current_nation["endorsements"] = (
-                            list(map(to_snake_case, child.text.split(",")))
-                            if child.text
-                            else []
-                        )
-                    case "NAME" | "FULLNAME" | "REGION" | "FLAG":
-                        current_nation[child.tag.lower()] = (
-                            child.text if child.text else ""
-                        )
-
-            nations.append(
-                {
-                    "name": to_snake_case(current_nation["name"]),
-                    "fullname": current_nation["fullname"],
-                    "region": to_snake_case(current_nation["region"]),
-                    "wa_member": current_nation["wa_member"],
-                    "endorsements": current_nation["endorsements"],
-                    "flag": current_nation["flag"],
-                    "timestamp": dump_time,
-                }
-            )
-
-    logger.info(f"Parsed {len(nations)} nations. ({time.time() - start_time:.2f}s)")
-
-    #### UPDATE DATABASE ####
-    logger.info("Updating database...")
+    def mark_ingested(self) -> None:
+        self.meta["ingested"] = True
+        self._save_meta()
+
+
+def parse_dump(inp: queue.Queue, out: queue.Queue, stop: threading.Event) -> float:
+    """Parse stage: turn dump chunks into batches of staging rows, returning busy
+    time. Each NATION is dropped from the tree once parsed, so memory stays flat."""
+    busy = 0.0
+    parser = XMLPullParser(("start", "end"))
+    root = None
+    batch = []
+    try:
+        while True:
+            chunk = get(inp, stop)
+            start_time = time.perf_counter()
+            if chunk is None:
+                parser.close()
+            else:
+                parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == "start":
+                    root = element if root is None else root
+                elif element.tag == "NATION":
+                    batch.append(parse_nation(element))
+                    root.clear()  # type: ignore
+            busy += time.perf_counter() - start_time
+            if chunk is None or len(batch) >= ROW_BATCH_SIZE:
+                put(out, batch, stop)
+                batch = []
+            if chunk is None:
+                return busy
+    finally:
+        put(out, None, stop)
+
+
+def record_phase(phase: str, rows: int, seconds: float) -> str:
+    """Record a phase's metrics, returning its duration and throughput for logging."""
+    rate = rows / seconds if seconds else 0.0
+    PHASE_ROWS.labels(phase).set(rows)
+    PHASE_SECONDS.labels(phase).set(seconds)
+    PHASE_ROWS_PER_SECOND.labels(phase).set(rate)
+    return f"{seconds:.2f}s, {rate:,.0f} rows/s"
+
+
+def stage_dump(cur: psycopg.Cursor, chunks: Iterable[bytes]) -> int:
+    """Stream the dump into the staging table, returning the number of nations.
+
+    Download, parsing and loading run concurrently, joined by bounded queues."""
     start_time = time.time()
+    logger.info("Streaming dump into staging table...")
+    cur.execute(CREATE_STAGING)
 
-    query = """INSERT INTO nations (name, fullname, region, wa_member, endorsements, flag, updated_at)
-                    VALUES (%(name)s, %(fullname)s, %(region)s, %(wa_member)s, %(endorsements)s, %(flag)s, %(timestamp)s)
-                    ON CONFLICT (name) DO UPDATE 
-                    SET fullname     = EXCLUDED.fullname, 
-                        region       = EXCLUDED.region,
-                        wa_member    = EXCLUDED.wa_member,
-                        endorsements = EXCLUDED.endorsements,
-                        flag         = EXCLUDED.flag
-                    WHERE nations.updated_at < EXCLUDED.updated_at"""
+    xml: queue.Queue[bytes | None] = queue.Queue(CHUNK_QUEUE_SIZE)
+    rows: queue.Queue[list | None] = queue.Queue(ROW_QUEUE_SIZE)
+    stop = threading.Event()
+    count, loading = 0, 0.0
+    with ThreadPoolExecutor(2, thread_name_prefix="ingest") as executor:
+        reader = executor.submit(read_dump, chunks, xml, stop)
+        parser = executor.submit(parse_dump, xml, rows, stop)
+        try:
+            with cur.copy(COPY_STAGING) as copy:
+                while (batch := rows.get()) is not None:
+                    load_start = time.perf_counter()
+                    for row in batch:
+                        copy.write_row(row)
+                    count += len(batch)
+                    loading += time.perf_counter() - load_start
+            reading, parsing = reader.result(), parser.result()
+        finally:
+            stop.set()
+
+    logger.info(
+        f"Staged {count} nations. ({record_phase('stage', count, time.time() - start_time)}; busy: read {reading:.2f}s, parse {parsing:.2f}s, load {loading:.2f}s)"
+    )
+    return count
+
+
+def ingest(chunks: Iterable[bytes], dump_time: datetime, full: bool = False) -> bool:
+    """Stage a dump and merge it into the database, returning whether it succeeded.
+
+    A full ingest writes every nation in the dump, even unchanged ones and ones the
+    consumer has updated since, to reset the database to the dump's state."""
+    params = {"dump_time": dump_time, "full": full}
+    logger.info(f"Ingesting dump from {dump_time:%Y-%m-%d %H:%M:%S %Z}")
 
     try:
         with psycopg.connect(**DB_CONFIG) as conn:
             with conn.cursor() as cur:
-                cur.executemany(
-                    query,
-                    nations,
+                #### EXTRACT, PARSE AND STAGE DUMP ####
+                count = stage_dump(cur, chunks)
+
+                #### UPDATE DATABASE ####
+                start_time = time.time()
+                cur.execute(SELECT_CHANGED, params)
+                changed = cur.rowcount
+                cur.execute(MERGE_NATIONS, params)
+                inserted, updated = cur.fetchone()  # type: ignore
+                logger.info(
+                    f"Merged nations: {inserted} inserted, {updated} changed, {count - changed} unchanged, {changed - inserted - updated} changed but newer in the database. ({record_phase('merge', changed, time.time() - start_time)})"
+                )
+
+                start_time = time.time()
+                cur.execute(DELETE_ENDORSEMENTS, params)
+                cur.execute(INSERT_ENDORSEMENTS, params)
+                logger.info(
+                    f"Loaded {cur.rowcount} endorsements. ({record_phase('endorsements', cur.rowcount, time.time() - start_time)})"
                 )
-        logger.info(
-            f"Successfully updated nations table with {len(nations)} nations in {time.time() - start_time:.2f} seconds."
-        )
+
+                start_time = time.time()
+                cur.execute(MARK_INACTIVE, params)
+                removed = cur.rowcount
+                logger.info(
+                    f"Marked {removed} removed nations inactive. ({record_phase('mark_inactive', removed, time.time() - start_time)})"
+                )
+
+                start_time = time.time()
+                cur.execute(UPSERT_FINGERPRINTS, params)
+                fingerprinted = cur.rowcount
+                cur.execute(DELETE_FINGERPRINTS)
+                logger.info(
+                    f"Updated {fingerprinted} fingerprints. ({record_phase('fingerprints', fingerprinted, time.time() - start_time)})"
+                )
+
+                start_time = time.time()
+                cur.execute(LOCK_REGIONS)
+                cur.execute(DELETE_REGIONS)
+                cur.execute(REBUILD_REGIONS)
+                logger.info(
+                    f"Rebuilt {cur.rowcount} regions. ({record_phase('regions', cur.rowcount, time.time() - start_time)})"
+                )
+                cur.execute(RECORD_DUMP, params)
+                cur.execute(NOTIFY_REGION_CHANGES)
     except Exception as e:
-        logger.error(f"Error updating database: {e}")
+        logger.error(f"Error ingesting dump: {e}")
+        return False
+    SUCCEEDED.set(1)
+    return True
+
+
+def fetch_and_ingest(full: bool = False) -> None:
+    """Ingest the latest dump, unless it is unchanged since it was last ingested and
+    the ingest isn't a full one."""
+    cache = DumpCache(DUMP_CACHE_DIR)
+    with sans.stream("GET", sans.NationsDump(), headers=cache.validators()) as response:
+        if response.status_code == 304:
+            if cache.meta.get("ingested") and not full:
+                logger.info("Dump unchanged since it was last ingested, skipping.")
+                return
+            logger.info("Dump unchanged, ingesting cached copy.")
+            chunks, dump_time = iter_file(cache.path), file_time(cache.path)
+        else:
+            response.raise_for_status()
+            if last_modified := response.headers.get("Last-Modified"):
+                dump_time = parsedate_to_datetime(last_modified)
+            else:
+                dump_time = datetime.now(timezone.utc).replace(
+                    hour=5, minute=30, second=0, microsecond=0
+                )
+            chunks = cache.download(response)
+        if ingest(chunks, dump_time, full):
+            cache.mark_ingested()
+
+
+def main():
+    initial_time = time.time()
+    parser = argparse.ArgumentParser(
+        description="Ingest the NationStates nations dump."
+    )
+    parser.add_argument(
+        "dump",
+        nargs="?",
+        help="path to a local .xml.gz dump to ingest instead of the latest one; "
+        "its modification time is taken as the dump time",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="write every nation in the dump, overwriting newer changes",
+    )
+    args = parser.parse_args()
+
+    if args.dump:
+        ingest(iter_file(args.dump), file_time(args.dump), args.full)
+    else:
+        sans.set_agent(USER_AGENT)  # type: ignore
+        try:
+            fetch_and_ingest(args.full)
+        except Exception as e:
+            logger.error(f"Error fetching dump: {e}")
 
+    if METRICS_TEXTFILE:
+        write_to_textfile(METRICS_TEXTFILE, registry)
     logger.info(f"All done! ({time.time() - initial_time:.2f}s)")
 
 
@@ -1,5 +1,6 @@
 CREATE EXTENSION IF NOT EXISTS moddatetime;
 CREATE EXTENSION IF NOT EXISTS fuzzystrmatch;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 create table nations (
   name text not null,
@@ -7,13 +8,55 @@ create table nations (
   region text not null,
   wa_member boolean not null default false,
   wa_delegate boolean not null default false,
-  endorsements text[] not null default '{}'::text[],
   flag text null,
   active boolean not null default true,
   updated_at timestamp with time zone null default now(),
   constraint nations_pkey primary key (name)
 ) TABLESPACE pg_default;
 
+create index nations_region_idx on nations (region);
+create index nations_region_wa_member_idx on nations (region, name) where wa_member;
+-- Nation search: prefix matches for autocomplete, nearest trigram matches for typos.
+create index nations_name_pattern_idx on nations (name text_pattern_ops);
+create index nations_name_trgm_idx on nations using gist (name gist_trgm_ops);
+
 create trigger handle_updated_at BEFORE
 update on nations for EACH row
-execute FUNCTION moddatetime ('updated_at');
\ No newline at end of file
+execute FUNCTION moddatetime ('updated_at');
+
+create table endorsements (
+  endorser text not null,
+  endorsee text not null,
+  constraint endorsements_pkey primary key (endorsee, endorser)
+) TABLESPACE pg_default;
+
+create index endorsements_endorser_idx on endorsements (endorser, endorsee);
+
+-- Per-region aggregates, kept up to date by the consumer as it applies events and
+-- rebuilt from nations by the ingester after each dump. Nations and WA members
+-- only count active nations.
+create table regions (
+  name text not null,
+  nations integer not null default 0,
+  wa_members integer not null default 0,
+  delegate text null,
+  delegate_endorsements integer not null default 0,
+  constraint regions_pkey primary key (name)
+) TABLESPACE pg_default;
+
+-- Content fingerprint of each nation as of the last ingested dump, so the ingester
+-- only writes nations that changed between dumps.
+create table dump_fingerprints (
+  name text not null,
+  fingerprint bigint not null,
+  constraint dump_fingerprints_pkey primary key (name)
+) TABLESPACE pg_default;
+
+
+-- Generation time of every dump the ingester has loaded. The consumer's journal is
+-- replayed from the latest one to recover state.
+create table ingested_dumps (
+  dump_time timestamp with time zone not null,
+  ingested_at timestamp with time zone not null default now(),
+  constraint ingested_dumps_pkey primary key (dump_time)
+) TABLESPACE pg_default;
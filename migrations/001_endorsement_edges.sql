@@ -0,0 +1,21 @@
+-- Move endorsements from the nations.endorsements array into an edge table.
+BEGIN;
+
+create table endorsements (
+  endorser text not null,
+  endorsee text not null,
+  constraint endorsements_pkey primary key (endorsee, endorser)
+) TABLESPACE pg_default;
+
+insert into endorsements (endorser, endorsee)
+select distinct endorser, name
+from nations, unnest(endorsements) as endorser
+where endorser <> '';
+
+create index endorsements_endorser_idx on endorsements (endorser, endorsee);
+create index nations_region_idx on nations (region);
+create index nations_region_wa_member_idx on nations (region, name) where wa_member;
+
+alter table nations drop column endorsements;
+
+COMMIT;
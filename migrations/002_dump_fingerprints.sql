@@ -0,0 +1,10 @@
+-- Track per-nation dump fingerprints for incremental ingestion.
+BEGIN;
+
+create table dump_fingerprints (
+  name text not null,
+  fingerprint bigint not null,
+  constraint dump_fingerprints_pkey primary key (name)
+) TABLESPACE pg_default;
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Record ingested dump times, so the consumer's journal can be replayed from them.
+BEGIN;
+
+create table ingested_dumps (
+  dump_time timestamp with time zone not null,
+  ingested_at timestamp with time zone not null default now(),
+  constraint ingested_dumps_pkey primary key (dump_time)
+) TABLESPACE pg_default;
+
+COMMIT;
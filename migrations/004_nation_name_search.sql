@@ -0,0 +1,9 @@
+-- Index nation names for prefix and trigram similarity search.
+BEGIN;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+create index nations_name_pattern_idx on nations (name text_pattern_ops);
+create index nations_name_trgm_idx on nations using gist (name gist_trgm_ops);
+
+COMMIT;
@@ -0,0 +1,23 @@
+-- Add per-region aggregates, built from the current state of nations.
+BEGIN;
+
+create table regions (
+  name text not null,
+  nations integer not null default 0,
+  wa_members integer not null default 0,
+  delegate text null,
+  delegate_endorsements integer not null default 0,
+  constraint regions_pkey primary key (name)
+) TABLESPACE pg_default;
+
+INSERT INTO regions (name, nations, wa_members, delegate, delegate_endorsements)
+SELECT r.*, (SELECT count(*) FROM endorsements AS e WHERE e.endorsee = r.delegate)
+FROM (
+    SELECT region,
+        count(*) FILTER (WHERE active),
+        count(*) FILTER (WHERE active AND wa_member),
+        min(name) FILTER (WHERE active AND wa_delegate)
+    FROM nations GROUP BY region
+) AS r (name, nations, wa_members, delegate);
+
+COMMIT;